@@ -12,17 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 import click
 
-from piggin.common.types import HashKeyType
-from piggin.s3.cli import s3
-from piggin.ec2.cli import ec2
+from piggin.common.types import HashKeyType, LazyGroup
+from piggin.common.auth import configure
 
 CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
                         allow_extra_args=True,
                         token_normalize_func=lambda x: x.lower())
+
+# subcommands are imported on first use to keep the startup fast.
+SUBCOMMANDS = {
+        's3': ('piggin.s3.cli.s3', 
+               'piggin s3 commands to interact with AWS s3 resources.'),
+        'ec2': ('piggin.ec2.cli.ec2', 
+                'piggin ec2 commands to interact with AWS ec2 resources.'),
+        'batch': ('piggin.daemon.batch',
+                  'run piggin commands from a file (or stdin) in a single '
+                  'process.'),
+        'daemon': ('piggin.daemon.daemon',
+                   'run piggin as a local daemon that other piggin calls '
+                   'forward to.'),
+        }
     
-@click.group()
+@click.group(cls=LazyGroup, lazy_subcommands=SUBCOMMANDS)
 @click.option(
     '--access-key', 
     '-a',
@@ -46,8 +60,51 @@ CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
     default=None,
     help='your AWS profile name'
 )
+@click.option(
+    '--max-connections',
+    envvar="PIGGIN_MAX_POOL_CONNECTIONS",
+    default=None,
+    type=click.IntRange(min=1),
+    help='maximum connections in the pool of each AWS client'
+)
+@click.option(
+    '--keepalive/--nokeepalive',
+    envvar="PIGGIN_TCP_KEEPALIVE",
+    default=True,
+    help='turn on/ off TCP keep-alive for AWS connections'
+)
+@click.option(
+    '--daemon-socket',
+    envvar="PIGGIN_SOCKET",
+    default=None,
+    help='forward the command to the piggin daemon on this socket, if one '
+    'is running'
+)
+@click.option(
+    '--stats',
+    envvar="PIGGIN_STATS",
+    is_flag=True,
+    default=False,
+    help='print a summary of AWS calls, latencies and bytes transferred to '
+    'stderr at exit'
+)
+@click.option(
+    '--stats-json',
+    envvar="PIGGIN_STATS_JSON",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='append every AWS call as a line of json to this file'
+)
+@click.option(
+    '--stats-prom',
+    envvar="PIGGIN_STATS_PROM",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='write the AWS call metrics to this prometheus textfile at exit'
+)
 @click.pass_context
-def main(ctx, access_key, secret_key, profile_name):
+def main(ctx, access_key, secret_key, profile_name, max_connections, 
+         keepalive, daemon_socket, stats, stats_json, stats_prom):
     """
         piggin is command line utility program to interact with 
         AWS resources.
@@ -56,15 +113,44 @@ def main(ctx, access_key, secret_key, profile_name):
             piggin --help\n
             piggin s3 subcommand [options]\n
             piggin ec2 subcommand [options]\n
+            piggin batch [file]\n
+            piggin daemon start|stop|status\n
     """
+    if daemon_socket and ctx.invoked_subcommand not in ('batch', 'daemon'):
+        from piggin.daemon import forward
+        code = forward(daemon_socket, sys.argv[1:])
+        if code is not None:
+            ctx.exit(code)
+    
+    configure(max_pool_connections=max_connections, tcp_keepalive=keepalive)
+    if stats or stats_json or stats_prom:
+        _instrument(ctx, stats, stats_json, stats_prom)
     ctx.obj = {
                'access_key': access_key,
                'secret_key': secret_key,
                'profile_name':profile_name,
                }
+
+def _instrument(ctx, stats, stats_json, stats_prom):
+    from piggin.common.metrics import Metrics, JsonLinesWriter
+    
+    metrics = Metrics()
+    writer = None
+    if stats_json:
+        writer = JsonLinesWriter(stats_json)
+        metrics.add_callback(writer)
+    configure(metrics=metrics)
+    
+    def report():
+        configure(metrics=None)
+        if writer:
+            writer.close()
+        if stats_prom:
+            metrics.write_prometheus(stats_prom)
+        if stats:
+            click.echo(metrics.summary(), err=True)
     
-main.add_command(s3)
-main.add_command(ec2)
+    ctx.call_on_close(report)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
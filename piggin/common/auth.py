@@ -12,3 +12,115 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
+# botocore defaults to 10 connections per client.
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_lock = threading.RLock()
+_defaults = {'max_pool_connections':DEFAULT_MAX_POOL_CONNECTIONS,
+             'tcp_keepalive':True, 'metrics':None}
+_sessions = {}
+_clients = {}
+_resources = {}
+
+def configure(max_pool_connections=None, tcp_keepalive=None, metrics=False):
+    """
+        set the process-wide defaults for new clients and resources. If 
+        `metrics` (a `piggin.common.metrics.Metrics`) is given, all cached
+        and new clients report to it, None stops reporting.
+    """
+    with _lock:
+        if max_pool_connections:
+            _defaults['max_pool_connections'] = max_pool_connections
+        if tcp_keepalive is not None:
+            _defaults['tcp_keepalive'] = tcp_keepalive
+        if metrics is not False and metrics is not _defaults['metrics']:
+            clients = [_client_of(obj) for _, obj in _clients.values()]
+            clients += [_client_of(obj) for _, obj in _resources.values()]
+            for client in clients:
+                if _defaults['metrics']:
+                    _defaults['metrics'].unregister(client)
+                if metrics:
+                    metrics.register(client)
+            _defaults['metrics'] = metrics
+
+def get_session(access_key=None, secret_key=None, profile_name=None):
+    """
+        return a cached boto3 session for the given credentials/ profile,
+        creating one on first use.
+    """
+    key = (access_key, secret_key, profile_name)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            import boto3
+            session = boto3.Session(aws_access_key_id=access_key,
+                                    aws_secret_access_key=secret_key,
+                                    profile_name=profile_name)
+            _sessions[key] = session
+        return session
+
+def get_client(service, access_key=None, secret_key=None, profile_name=None,
+               region_name=None, max_pool_connections=None):
+    """
+        return a cached client for the service, credentials and region.
+        The client is replaced by a new one with a bigger connection pool
+        if `max_pool_connections` exceeds that of the cached client.
+    """
+    return _get_cached(_clients, 'client', service, access_key, secret_key,
+                       profile_name, region_name, max_pool_connections)
+
+def get_resource(service, access_key=None, secret_key=None,
+                 profile_name=None, region_name=None,
+                 max_pool_connections=None):
+    """
+        return a cached resource for the service, credentials and region.
+        Unlike clients, resources are not thread-safe.
+    """
+    return _get_cached(_resources, 'resource', service, access_key,
+                       secret_key, profile_name, region_name,
+                       max_pool_connections)
+
+def clear():
+    """
+        drop all cached sessions, clients and resources.
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _resources.clear()
+
+def _get_cached(cache, kind, service, access_key, secret_key, profile_name,
+                region_name, max_pool_connections):
+    key = (service, access_key, secret_key, profile_name, region_name)
+    with _lock:
+        pool_size = max(max_pool_connections or 0,
+                        _defaults['max_pool_connections'])
+        cached = cache.get(key)
+        if cached is not None and cached[0] >= pool_size:
+            return cached[1]
+
+        session = get_session(access_key, secret_key, profile_name)
+        factory = session.client if kind == 'client' else session.resource
+        obj = factory(service, region_name=region_name,
+                      config=_make_config(pool_size))
+        if _defaults['metrics']:
+            _defaults['metrics'].register(_client_of(obj))
+        cache[key] = (pool_size, obj)
+        return obj
+
+def _client_of(obj):
+    # the low-level client of a client or resource.
+    meta = obj.meta
+    return getattr(meta, 'client', obj)
+
+def _make_config(max_pool_connections):
+    from botocore.config import Config
+
+    try:
+        return Config(max_pool_connections=max_pool_connections,
+                      tcp_keepalive=_defaults['tcp_keepalive'])
+    except TypeError:
+        # tcp_keepalive is not supported by older botocore.
+        return Config(max_pool_connections=max_pool_connections)
@@ -0,0 +1,305 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+
+from piggin.common.utils import register_hook
+
+# upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+# botocore events observed, see `Metrics.register`.
+EVENTS = ('before-call', 'after-call', 'after-call-error')
+
+_CONTEXT_KEY = 'piggin_metrics_start'
+
+class OperationStats(object):
+    '''
+        Counters and a latency histogram of one AWS operation.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0]*(len(LATENCY_BUCKETS)+1)
+
+    def add(self, latency, error, retries, bytes_in, bytes_out):
+        self.calls += 1
+        self.errors += int(error)
+        self.retries += retries
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def quantile(self, q):
+        """
+            estimate of the latency quantile `q`, the upper bound of the
+            histogram bucket it falls in.
+        """
+        rank = q*self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.latency_max)
+        return self.latency_max
+
+    def to_dict(self):
+        return {'calls':self.calls, 'errors':self.errors,
+                'retries':self.retries, 'bytes_in':self.bytes_in,
+                'bytes_out':self.bytes_out,
+                'latency_sum':round(self.latency_sum, 6),
+                'latency_max':round(self.latency_max, 6),
+                'latency_p50':round(self.quantile(0.5), 6),
+                'latency_p99':round(self.quantile(0.99), 6)}
+
+class Metrics(object):
+    '''
+        Instrumentation of AWS clients through botocore events: per
+        operation call and error counts, latency histograms, bytes sent
+        and received, retries (as reported by botocore) and the number
+        of calls in flight, with its peak.
+
+        Register clients with `register` (or pass the metrics to `AwsS3`
+        or `AwsEC2`, or to `piggin.common.auth.configure` for all clients
+        of the process). Each finished call is also passed as a dict to
+        the callbacks added with `add_callback`, e.g. a `JsonLinesWriter`.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._callbacks = []
+        self._start = time.time()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._logger = logging.getLogger('piggin')
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def register(self, client):
+        """
+            instrument a client. A client is instrumented by one `Metrics`
+            at a time, registering replaces the earlier one.
+        """
+        for event in EVENTS:
+            register_hook(
+                    client, event,
+                    getattr(self, '_on_'+event.replace('-', '_')),
+                    self._unique_id(event))
+
+    def unregister(self, client):
+        for event in EVENTS:
+            client.meta.events.unregister(
+                    event, unique_id=self._unique_id(event))
+
+    def _unique_id(self, event):
+        return f'piggin-metrics-{event}'
+
+    def _on_before_call(self, params, context, **kwargs):
+        context[_CONTEXT_KEY] = (time.perf_counter(), _request_size(params))
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _on_after_call(self, event_name, context, http_response=None,
+                       parsed=None, **kwargs):
+        parsed = parsed or {}
+        metadata = parsed.get('ResponseMetadata', {})
+        status = metadata.get('HTTPStatusCode') or getattr(
+                http_response, 'status_code', None)
+        bytes_in = parsed.get('ContentLength')
+        if bytes_in is None and http_response is not None:
+            bytes_in = http_response.headers.get('content-length')
+        self._record(event_name, context, status, None,
+                     metadata.get('RetryAttempts', 0), int(bytes_in or 0))
+
+    def _on_after_call_error(self, event_name, context, exception=None,
+                             **kwargs):
+        self._record(event_name, context, None, exception, 0, 0)
+
+    def _record(self, event_name, context, status, exception, retries, 
+                bytes_in):
+        start, bytes_out = context.pop(_CONTEXT_KEY, (None, 0))
+        if start is None:
+            return
+        latency = time.perf_counter() - start
+        error = exception is not None or (status or 0) >= 400
+        # the event name is `after-call.<service>.<operation>`.
+        _, service, operation = event_name.split('.', 2)
+        key = (service, operation)
+
+        with self._lock:
+            self.in_flight -= 1
+            stats = self._operations.get(key)
+            if stats is None:
+                stats = self._operations[key] = OperationStats()
+            stats.add(latency, error, retries, bytes_in, bytes_out)
+
+        if not self._callbacks:
+            return
+        event = {'time':time.time(), 'service':service,
+                 'operation':operation, 'latency':latency, 'status':status,
+                 'error':str(exception) if exception else None,
+                 'retries':retries, 'bytes_in':bytes_in,
+                 'bytes_out':bytes_out}
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                self._logger.error('metrics callback failed:'+str(e))
+
+    def snapshot(self):
+        """
+            the current counters, keyed by `service.operation`.
+        """
+        with self._lock:
+            operations = {f'{s}.{o}':stats.to_dict() for (s, o), stats in
+                          sorted(self._operations.items())}
+            return {'elapsed':time.time()-self._start,
+                    'in_flight':self.in_flight,
+                    'peak_in_flight':self.peak_in_flight,
+                    'operations':operations}
+
+    def summary(self):
+        """
+            a human readable table of the counters.
+        """
+        snapshot = self.snapshot()
+        elapsed = max(snapshot['elapsed'], 1e-6)
+        lines = [f'{"operation":32}{"calls":>8}{"errors":>8}{"retries":>8}'
+                 f'{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}{"MB in":>9}'
+                 f'{"MB out":>9}']
+        total_in = total_out = 0
+        for name, s in snapshot['operations'].items():
+            total_in += s['bytes_in']
+            total_out += s['bytes_out']
+            lines.append(
+                    f'{name:32}{s["calls"]:>8}{s["errors"]:>8}'
+                    f'{s["retries"]:>8}{1000*s["latency_p50"]:>9.1f}'
+                    f'{1000*s["latency_p99"]:>9.1f}'
+                    f'{1000*s["latency_max"]:>9.1f}'
+                    f'{s["bytes_in"]/2**20:>9.1f}'
+                    f'{s["bytes_out"]/2**20:>9.1f}')
+        lines.append(
+                f'elapsed {elapsed:.1f}s, peak in flight '
+                f'{snapshot["peak_in_flight"]}, in '
+                f'{total_in/2**20/elapsed:.1f} MB/s, out '
+                f'{total_out/2**20/elapsed:.1f} MB/s.')
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """
+            the counters in the prometheus text exposition format.
+        """
+        with self._lock:
+            operations = sorted(self._operations.items())
+            in_flight, peak = self.in_flight, self.peak_in_flight
+
+        lines = []
+        def metric(name, kind, help_text):
+            lines.append(f'# HELP piggin_{name} {help_text}')
+            lines.append(f'# TYPE piggin_{name} {kind}')
+
+        counters = [('calls', 'calls_total', 'AWS API calls.'),
+                    ('errors', 'errors_total', 'failed AWS API calls.'),
+                    ('retries', 'retries_total', 'retries of AWS API calls.'),
+                    ('bytes_in', 'received_bytes_total', 'bytes received.'),
+                    ('bytes_out', 'sent_bytes_total', 'bytes sent.')]
+        for attr, name, help_text in counters:
+            metric(name, 'counter', help_text)
+            for (service, operation), stats in operations:
+                lines.append(
+                        f'piggin_{name}{{service="{service}",operation='
+                        f'"{operation}"}} {getattr(stats, attr)}')
+
+        metric('call_duration_seconds', 'histogram',
+               'latency of AWS API calls.')
+        for (service, operation), stats in operations:
+            labels = f'service="{service}",operation="{operation}"'
+            count = 0
+            for bound, n in zip(LATENCY_BUCKETS, stats.buckets):
+                count += n
+                lines.append(f'piggin_call_duration_seconds_bucket{{'
+                             f'{labels},le="{bound}"}} {count}')
+            lines.append(f'piggin_call_duration_seconds_bucket{{{labels},'
+                         f'le="+Inf"}} {stats.calls}')
+            lines.append(f'piggin_call_duration_seconds_sum{{{labels}}} '
+                         f'{stats.latency_sum}')
+            lines.append(f'piggin_call_duration_seconds_count{{{labels}}} '
+                         f'{stats.calls}')
+
+        metric('in_flight', 'gauge', 'AWS API calls in flight.')
+        lines.append(f'piggin_in_flight {in_flight}')
+        metric('peak_in_flight', 'gauge', 'peak AWS API calls in flight.')
+        lines.append(f'piggin_peak_in_flight {peak}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+            write the counters to a prometheus (node exporter) textfile,
+            atomically replacing it.
+        """
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+class JsonLinesWriter(object):
+    '''
+        A metrics callback appending each call as a line of json to a
+        file.
+    '''
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._fp = open(path, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event)+'\n'
+        with self._lock:
+            self._fp.write(line)
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+def _request_size(params):
+    # `params` is the serialized request dict of a `before-call` event.
+    length = params.get('headers', {}).get('Content-Length')
+    if length is not None:
+        return int(length)
+    body = params.get('body')
+    if hasattr(body, '__len__'):
+        return len(body)
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        end = body.seek(0, os.SEEK_END)
+        body.seek(position)
+        return end - position
+    return 0
@@ -15,7 +15,49 @@
 import click
 import re
 import os
+import importlib
 
+class LazyGroup(click.Group):
+    '''
+        A click group that imports its subcommands only when they are 
+        invoked. The `lazy_subcommands` maps the command name to a tuple 
+        of the import path of the command and its short help, so that the 
+        help listing does not need an import either.
+    '''
+    
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+        
+    def list_commands(self, ctx):
+        commands = super(LazyGroup, self).list_commands(ctx)
+        return sorted(set(commands) | set(self.lazy_subcommands))
+    
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and \
+                cmd_name not in self.commands:
+            import_path, _ = self.lazy_subcommands[cmd_name]
+            module_name, attr = import_path.rsplit('.', 1)
+            module = importlib.import_module(module_name)
+            self.add_command(getattr(module, attr), cmd_name)
+        return super(LazyGroup, self).get_command(ctx, cmd_name)
+    
+    def format_commands(self, ctx, formatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                cmd = self.commands[name]
+                if cmd.hidden:
+                    continue
+                help_text = cmd.get_short_help_str()
+            else:
+                help_text = self.lazy_subcommands[name][1]
+            rows.append((name, help_text))
+        
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+            
 class HashKeyType(click.ParamType):
     name = 'SHA KEY'
     def __init__(self, length=32):
@@ -32,6 +74,21 @@ class HashKeyType(click.ParamType):
             self.fail(f'{value} is not a valid SHA/ MD5 key', param, ctx)
         return value
         
+class ByteSizeType(click.ParamType):
+    name = 'SIZE'
+    _units = {'':1, 'k':1024, 'm':1024**2, 'g':1024**3, 't':1024**4}
+    
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        
+        pattern = r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$"
+        matched = re.match(pattern, str(value).lower())
+        if not matched:
+            self.fail(f'{value} is not a valid size (e.g. 64MB)', param, ctx)
+        number, unit = matched.groups()
+        return int(float(number)*self._units[unit])
+        
 class OSEnvAwsReset():
     '''
         A context manager for handling AWS keys environment variable
@@ -15,6 +15,17 @@
 import os
 import json
 import re
+import logging
+import threading
+
+logger = logging.getLogger('piggin')
+
+# confirmations are refused without prompting when False, e.g. in the
+# daemon or in batch mode, see `set_interactive`.
+_interactive = True
+_declined = 0
+
+_hooks_lock = threading.Lock()
 
 
 def read_tags(tag):
@@ -26,13 +37,12 @@ def read_tags(tag):
         with open(tag) as fp:
             tags = json.load(fp)
     elif os.path.isfile(os.path.join(os.path.expanduser("~"),tag)):
-        target = os.path.isfile(os.path.join(os.path.expanduser("~"),tag))
+        target = os.path.join(os.path.expanduser("~"),tag)
         with open(target) as fp:
             tags = json.load(fp)
     elif isinstance(tag, str):
         values = re.split(';|,|\n',tag)
         if values:
-            print(values)
             tags = {}
             for item in values:
                 if '=' not in item:
@@ -43,12 +53,49 @@ def read_tags(tag):
     return tags
         
         
+def set_interactive(interactive):
+    """
+        turn on/ off prompting for confirmations. When off, confirmations
+        are declined, as there is no terminal to answer from (the daemon)
+        or stdin holds the commands themselves (batch mode).
+    """
+    global _interactive
+    _interactive = interactive
+
+def pop_declined():
+    """
+        the number of confirmations declined since the last call.
+    """
+    global _declined
+    declined, _declined = _declined, 0
+    return declined
+
+def register_hook(client, event, handler, unique_id):
+    """
+        register a botocore event handler on a (shared) client, replacing
+        the handler registered before under the same `unique_id`, if any.
+    """
+    with _hooks_lock:
+        client.meta.events.unregister(event, unique_id=unique_id)
+        client.meta.events.register(event, handler, unique_id=unique_id)
+
 def confirm_action(msg):
+    global _declined
+    if not _interactive:
+        logger.error(f'{msg}? cannot confirm here, pass --silent (or '
+                     f'--yes) to run without confirmation.')
+        _declined += 1
+        return False
+    
     msg = msg+f'[y/N]?:'
-    action = input(msg).lower()
+    try:
+        action = input(msg).lower()
+    except EOFError:
+        # no terminal to confirm from.
+        action = ''
     
     if action not in ['y','yes']:
+        _declined += 1
         return False
     
     return True
-    
\ No newline at end of file
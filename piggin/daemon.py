@@ -0,0 +1,297 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import json
+import shlex
+import socket
+import logging
+import contextlib
+
+import click
+
+from piggin.common.utils import set_interactive, pop_declined
+
+logger = logging.getLogger('piggin')
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.piggin',
+                              'piggin.sock')
+
+# environment forwarded from the client to the daemon with each command.
+FORWARD_ENV = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+               'AWS_SESSION_TOKEN', 'AWS_PROFILE', 'AWS_DEFAULT_REGION',
+               'AWS_REGION']
+
+# s3 commands writing binary output to stdout, which is not relayed.
+STDOUT_COMMANDS = ['cat', 'query']
+
+# set in the daemon process, so that commands it runs are not forwarded.
+IN_DAEMON = False
+
+CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
+                        allow_extra_args=True,
+                        token_normalize_func=lambda x: x.lower())
+
+def run_command(args):
+    """
+        run a piggin command (a list of arguments, without the program
+        name) in the current process, returns the exit code.
+    """
+    from piggin.__main__ import main
+
+    pop_declined()
+    try:
+        code = main.main(args=args, prog_name='piggin',
+                         standalone_mode=False)
+        code = code if isinstance(code, int) else 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo('Aborted!', err=True)
+        return 1
+    except Exception as e:
+        logger.error(f'failed running {" ".join(args)}:'+str(e))
+        return 1
+
+    # a declined confirmation means the command did not run.
+    if pop_declined() and not code:
+        code = 1
+    return code
+
+def forward(socket_path, args):
+    """
+        forward a command to the daemon listening on `socket_path` and
+        relay its output. Returns the exit code, or None if there is no
+        daemon to forward to.
+    """
+    if IN_DAEMON or not hasattr(socket, 'AF_UNIX'):
+        return None
+    if not os.path.exists(socket_path):
+        return None
+    if '-' in args:
+        # stdin and stdout pipes are not relayed, stream in this process.
+        return None
+    if 's3' in args:
+        rest = args[args.index('s3')+1:]
+        if any(arg.lower() in STDOUT_COMMANDS for arg in rest):
+            return None
+
+    env = {k:os.environ[k] for k in FORWARD_ENV if k in os.environ}
+    request = {'argv':list(args), 'cwd':os.getcwd(), 'env':env}
+    try:
+        response = _request(socket_path, request)
+    except (ConnectionError, FileNotFoundError):
+        return None
+
+    sys.stdout.write(response.get('stdout', ''))
+    sys.stderr.write(response.get('stderr', ''))
+    return response.get('code', 1)
+
+def _request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode()+b'\n')
+        with sock.makefile('rb') as fp:
+            return json.loads(fp.readline() or b'{}')
+
+class Daemon(object):
+    '''
+        A local server on a unix socket running forwarded piggin commands
+        in a single long-lived process, so that imports, sessions, client
+        connection pools and caches stay warm across commands. Commands
+        are run one at a time, each with its own working directory, AWS
+        environment and captured output.
+    '''
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self._socket_path = socket_path
+        self._running = False
+
+    def serve(self):
+        global IN_DAEMON
+        IN_DAEMON = True
+        # the daemon has no terminal, and blocking on stdin would stall
+        # all forwarded commands.
+        set_interactive(False)
+
+        dirname = os.path.dirname(self._socket_path)
+        if dirname:
+            os.makedirs(dirname, mode=0o700, exist_ok=True)
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self._socket_path)
+            os.chmod(self._socket_path, 0o600)
+            server.listen()
+            self._running = True
+            try:
+                while self._running:
+                    conn, _ = server.accept()
+                    with conn:
+                        self._handle(conn)
+            finally:
+                os.remove(self._socket_path)
+
+    def _handle(self, conn):
+        with conn.makefile('rb') as fp:
+            line = fp.readline()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return
+
+        command = request.get('command', 'run')
+        if command == 'stop':
+            self._running = False
+            response = {'code':0, 'stdout':'piggin daemon stopped.\n'}
+        elif command == 'ping':
+            response = {'code':0, 'stdout':f'piggin daemon running, pid '
+                        f'{os.getpid()}.\n'}
+        else:
+            response = self._run(request)
+
+        conn.sendall(json.dumps(response).encode()+b'\n')
+
+    def _run(self, request):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        cwd = os.getcwd()
+        env = {k:os.environ.get(k) for k in FORWARD_ENV}
+        try:
+            for k in FORWARD_ENV:
+                os.environ.pop(k, None)
+            os.environ.update(request.get('env', {}))
+            os.chdir(request.get('cwd', cwd))
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                code = run_command(request.get('argv', []))
+        finally:
+            os.chdir(cwd)
+            for k, v in env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+        return {'code':code, 'stdout':stdout.getvalue(),
+                'stderr':stderr.getvalue()}
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('file', default='-', type=click.File('r'))
+@click.option(
+    '--stop-on-error/--continue-on-error',
+    default=False,
+    help='Stop at the first failed command.')
+@click.pass_context
+def batch(ctx, file, stop_on_error):
+    """
+        run piggin commands from a file (or stdin) in a single process.
+
+        Each line is a piggin command, with or without the leading
+        `piggin`. Blank lines and lines starting with # are skipped.
+        All commands share sessions, clients and connection pools.
+    """
+    common = []
+    if ctx.obj.get('access_key'):
+        common.extend(['--access-key', ctx.obj['access_key']])
+    if ctx.obj.get('secret_key'):
+        common.extend(['--secret-key', ctx.obj['secret_key']])
+    if ctx.obj.get('profile_name'):
+        common.extend(['--profile-name', ctx.obj['profile_name']])
+
+    # prompts would read the next commands (from stdin) as the answer.
+    set_interactive(False)
+    failed = 0
+    try:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            args = shlex.split(line)
+            if args[0] == 'piggin':
+                args = args[1:]
+
+            code = run_command(common+args)
+            if code:
+                failed += 1
+                logger.error(f'command failed with exit code {code}: '
+                             f'{line}')
+                if stop_on_error:
+                    break
+    finally:
+        set_interactive(True)
+
+    if failed:
+        ctx.exit(1)
+
+@click.group()
+@click.option(
+    '--socket',
+    'socket_path',
+    envvar='PIGGIN_SOCKET',
+    default=DEFAULT_SOCKET,
+    help='Path of the daemon unix socket.')
+@click.pass_context
+def daemon(ctx, socket_path):
+    """
+        run piggin as a local daemon that other piggin calls forward to.
+
+        Usage:\n
+            piggin daemon start\n
+            piggin daemon status\n
+            piggin daemon stop\n
+
+        Commands are forwarded to a running daemon if the environment
+        variable PIGGIN_SOCKET (or the option --daemon-socket) points
+        to its socket.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise click.ClickException('unix sockets are not supported.')
+    ctx.obj['socket'] = socket_path
+
+@daemon.command(context_settings=CONTEXT_SETTINGS)
+@click.pass_context
+def start(ctx):
+    """
+        start the daemon in the foreground.
+    """
+    print(f'piggin daemon listening on {ctx.obj["socket"]}.')
+    Daemon(ctx.obj['socket']).serve()
+
+@daemon.command(context_settings=CONTEXT_SETTINGS)
+@click.pass_context
+def stop(ctx):
+    """
+        stop a running daemon.
+    """
+    _control(ctx, 'stop')
+
+@daemon.command(context_settings=CONTEXT_SETTINGS)
+@click.pass_context
+def status(ctx):
+    """
+        check if a daemon is running.
+    """
+    _control(ctx, 'ping')
+
+def _control(ctx, command):
+    try:
+        response = _request(ctx.obj['socket'], {'command':command})
+    except (ConnectionError, FileNotFoundError):
+        print('piggin daemon not running.')
+        ctx.exit(1)
+    sys.stdout.write(response.get('stdout', ''))
@@ -0,0 +1,121 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import threading
+from functools import partial
+
+from piggin.common.utils import register_hook
+
+DEFAULT_TTL = 30
+
+# ec2 operations that change the state or tags of instances.
+MUTATING_OPERATIONS = ['RunInstances', 'CreateFleet', 'StartInstances',
+                       'StopInstances', 'RebootInstances',
+                       'TerminateInstances', 'CreateTags', 'DeleteTags',
+                       'ModifyInstanceAttribute']
+
+class InstanceCache(object):
+    '''
+        A short lived json backed cache of instance listings, keyed by
+        the account, the region and the filters of the listing. Entries
+        expire after `ttl` seconds, and state changes or tag writes
+        through piggin drop the cached listings of their region. The
+        file is re-read on every lookup and replaced atomically, so
+        concurrent piggin processes can share it.
+    '''
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.piggin',
+                                'ec2cache.json')
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, account, region, filters):
+        return json.dumps([account or '', region or '', filters],
+                          sort_keys=True)
+
+    def get(self, key):
+        """
+            the cached rows of a listing, or None if there are no fresh
+            ones.
+        """
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or entry['fetched'] < time.time()-self._ttl:
+            return None
+        return entry['rows']
+
+    def put(self, key, region, rows):
+        now = time.time()
+        with self._lock:
+            data = {k:v for k, v in self._load().items()
+                    if v['fetched'] >= now-self._ttl}
+            data[key] = {'region':region or '', 'fetched':now, 'rows':rows}
+            self._save(data)
+
+    def invalidate(self, region=None):
+        """
+            drop the cached listings of a region, or of all regions.
+        """
+        with self._lock:
+            data = self._load()
+            kept = {k:v for k, v in data.items()
+                    if region is not None and v['region'] != region}
+            if len(kept) != len(data):
+                self._save(kept)
+
+    def clear(self):
+        self.invalidate()
+
+    def _load(self):
+        try:
+            with open(self._path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        tmp = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, self._path)
+
+    def on_mutation(self, region, **kwargs):
+        """
+            botocore `before-parameter-build` handler to invalidate the
+            listings of the region of a write.
+        """
+        self.invalidate(region)
+
+    def register(self, client):
+        """
+            register invalidation hooks on an ec2 client, replacing those
+            of an earlier cache on the same file.
+        """
+        region = client.meta.region_name or ''
+        for operation in MUTATING_OPERATIONS:
+            register_hook(
+                    client, f'before-parameter-build.ec2.{operation}',
+                    partial(self.on_mutation, region),
+                    f'piggin-ec2-cache-{self._path}-{operation}')
@@ -13,9 +13,15 @@
 # limitations under the License.
 
 
+import sys
+import csv
+import json
 import click
-from piggin.ec2.ec2 import AwsEC2
 from piggin.common.types import OSEnvAwsReset
+from piggin.common.utils import read_tags, confirm_action
+
+# the heavy modules (boto3 and the service wrappers) are imported
+# inside the commands on first use, see `piggin.__main__`.
 
 CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
                         allow_extra_args=True,
@@ -25,10 +31,22 @@ CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
 @click.option(
     '--region',
     '-r',
-    default='us-east-1',
-    help='AWS region.')
+    default=None,
+    help='AWS region, that of the profile/ environment or us-east-1 if '
+    'not given.')
+@click.option(
+    '--cache/--nocache',
+    envvar='PIGGIN_EC2_CACHE',
+    default=False,
+    help='Turn on/ off the local instance listing cache.')
+@click.option(
+    '--cache-ttl',
+    envvar='PIGGIN_EC2_CACHE_TTL',
+    default=30,
+    type=click.IntRange(min=0),
+    help='Expiry of cached listings in seconds.')
 @click.pass_context
-def ec2(ctx, region):
+def ec2(ctx, region, cache, cache_ttl):
     """
         piggin ec2 commands to interact with AWS ec2 resources.
         
@@ -37,48 +55,451 @@ def ec2(ctx, region):
             piggin ec2 ls [options]\n
             piggin ec2 create [options]\n
             piggin ec2 tag [options]\n
+            piggin ec2 start [options]\n
+            piggin ec2 stop [options]\n
             piggin ec2 rm [options]\n
-            piggin ec2 update [options]\n
     """
     ctx.obj['region'] = region
+    ctx.obj['cache'] = None
+    if cache:
+        from piggin.ec2.cache import InstanceCache
+        ctx.obj['cache'] = InstanceCache(ttl=cache_ttl)
+
+def _parse_tags(tags):
+    # `key=value` filters on a tag value, `key` on the tag being set.
+    parsed = {}
+    for tag in tags:
+        key, sep, value = tag.partition('=')
+        if not sep:
+            parsed[key] = None
+        elif parsed.get(key):
+            parsed[key].append(value)
+        else:
+            parsed[key] = [value]
+    return parsed
+
+def _print_instances(rows, output, columns):
+    if output == 'json':
+        print(json.dumps(rows, indent=2))
+        return
+    
+    if output == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns, 
+                                extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            tags = ';'.join(f'{k}={v}' for k, v in row['tags'].items())
+            writer.writerow(dict(row, tags=tags))
+        return
+    
+    widths = {'id':21, 'name':20, 'state':14, 'type':12, 'key_name':20, 
+              'private_ip':16, 'public_ip':16, 'region':16, 'zone':16}
+    columns = [c for c in columns if c in widths]
+    print(''.join(f'{c:{widths[c]}}' for c in columns))
+    print('_'*sum(widths[c] for c in columns))
+    for row in rows:
+        print(''.join(f'{str(row[c] or "-")[:widths[c]-1]:{widths[c]}}' 
+                      for c in columns))
+    print('_'*sum(widths[c] for c in columns))
+    print(f'total instances {len(rows)}')
 
 @ec2.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    '--state',
+    'states',
+    multiple=True,
+    type=click.Choice(['pending', 'running', 'shutting-down', 'terminated',
+                       'stopping', 'stopped']),
+    help='List only instances in this state, can be repeated. [all]')
+@click.option(
+    '--tag',
+    'tags',
+    multiple=True,
+    help='List only instances with this tag, as key=value or key, can be '
+    'repeated.')
+@click.option(
+    '--instance-type',
+    '-t',
+    'instance_types',
+    multiple=True,
+    help='List only instances of this type, can be repeated.')
+@click.option(
+    '--id',
+    'ids',
+    multiple=True,
+    help='List only this instance, can be repeated.')
+@click.option(
+    '--regions',
+    default=None,
+    help='Comma separated regions to list at the same time, instead of '
+    'the --region of the group.')
+@click.option(
+    '--all-regions',
+    is_flag=True,
+    default=False,
+    help='List all regions enabled for the account at the same time.')
+@click.option(
+    '--output',
+    '-o',
+    default='table',
+    type=click.Choice(['table', 'csv', 'json']),
+    help='Output format. [table]')
 @click.option(
     '--verbose/--silent',
     default=False,
     help='Turn on/ off verbosity. [verbose/silent]')
 @click.pass_context
-def ls(ctx, verbose):
+def ls(ctx, states, tags, instance_types, ids, regions, all_regions, 
+       output, verbose):
     """
-        list ec2 instances.
+        list ec2 instances, of one or several regions.
     """
     access_key = ctx.obj['access_key']
     secret_key = ctx.obj['secret_key']
     profile_name = ctx.obj['profile_name']
     region = ctx.obj['region']
-    count = 0
+    
+    from piggin.ec2.ec2 import AwsEC2, COLUMNS
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        ec2 = AwsEC2(access_key, secret_key, profile_name, region,
+                     cache=ctx.obj['cache'])
+        kwargs = dict(states=states, tags=_parse_tags(tags), 
+                      instance_types=instance_types, ids=ids)
+        if not (regions or all_regions):
+            rows = ec2.ls(**kwargs)
+            if rows is None:
+                ctx.exit(1)
+            _print_instances(
+                    rows, output, [c for c in COLUMNS if c != 'region'])
+            return
+        
+        if regions:
+            regions = [r.strip() for r in regions.split(',') if r.strip()]
+        else:
+            try:
+                regions = ec2.regions()
+            except Exception as e:
+                raise click.ClickException(f'listing regions:{e}')
+        
+        # the regions are merged in the order given, whichever completes
+        # first.
+        results = {}
+        for region, rows, elapsed in ec2.ls_regions(regions, **kwargs):
+            results[region] = rows
+            status = 'failed' if rows is None else f'{len(rows)} instances'
+            print(f'{region:16}{status:20}{elapsed:8.2f}s', file=sys.stderr)
+    
+    rows = [row for r in regions for row in results[r] or []]
+    _print_instances(rows, output, COLUMNS)
+    if None in results.values():
+        ctx.exit(1)
+    
+@ec2.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    '--image-id',
+    default=None,
+    help='AMI to launch.')
+@click.option(
+    '--count',
+    '-n',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Number of instances to launch. [1]')
+@click.option(
+    '--instance-type',
+    '-t',
+    'instance_types',
+    multiple=True,
+    help='Instance type, repeat to diversify a fleet across types. '
+    '[t2.micro]')
+@click.option(
+    '--launch-template',
+    default=None,
+    help='Launch template (name or lt- id) to launch a fleet from, '
+    'instead of the image and volume options.')
+@click.option(
+    '--capacity',
+    default=None,
+    type=click.Choice(['on-demand', 'spot']),
+    help='Capacity type, spot instances are launched as a fleet. '
+    '[on-demand]')
+@click.option(
+    '--target-vcpus',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Launch a fleet of this many vCPUs (each instance type weighted '
+    'by its vCPUs) instead of a count of instances.')
+@click.option(
+    '--allocation',
+    default=None,
+    type=click.Choice(['capacity-optimized', 'price-capacity-optimized', 
+                       'capacity-optimized-prioritized', 'lowest-price', 
+                       'diversified', 'prioritized']),
+    help='Fleet allocation strategy, lowest-price or prioritized for '
+    'on-demand, any but prioritized for spot. [capacity-optimized for '
+    'spot, lowest-price for on-demand]')
+@click.option(
+    '--key-name',
+    default=None,
+    help='Name of the key pair.')
+@click.option(
+    '--ebs-size',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Size of the root volume in GB.')
+@click.option(
+    '--ebs-type',
+    default=None,
+    help='Type of the root volume. [standard]')
+@click.option(
+    '--subnet',
+    'subnets',
+    multiple=True,
+    help='Subnet to launch in, repeat to spread the instances across '
+    'subnets.')
+@click.option(
+    '--tags',
+    default=None,
+    help='Tags as key=value pairs separated by commas, or a json file.')
+@click.option(
+    '--config',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help='Json file with defaults for the options above, and the '
+    'subnet(s) and security group.')
+@click.option(
+    '--wait',
+    default='running',
+    type=click.Choice(['none', 'running', 'ok']),
+    help='Return after launch, once all instances are running, or once '
+    'their status checks pass. [running]')
+@click.pass_context
+def create(ctx, image_id, count, instance_types, launch_template, capacity,
+           target_vcpus, allocation, key_name, ebs_size, ebs_type, subnets,
+           tags, config, wait):
+    """
+        launch ec2 instances.
+    """
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
+    region = ctx.obj['region']
+    
+    from piggin.ec2.ec2 import AwsEC2, ALLOCATIONS
+    
+    # a capacity from the config file is checked on launch.
+    if allocation and (capacity or not config):
+        capacity_type = capacity or 'on-demand'
+        if allocation not in ALLOCATIONS[capacity_type]:
+            msg = f'{allocation} is not allowed with {capacity_type} '
+            msg = msg + 'capacity, choose from '
+            msg = msg + f'{", ".join(ALLOCATIONS[capacity_type])}.'
+            raise click.BadParameter(msg, param_hint='--allocation')
     
     with OSEnvAwsReset(access_key, secret_key):
         ec2 = AwsEC2(access_key, secret_key, profile_name, region)
-        instances = ec2.ls()
+        try:
+            instances = ec2.create_ec2(
+                    image_id, count, key_name, ebs_size, 
+                    list(instance_types), tags, ebs_type, config, 
+                    subnets=list(subnets), wait=wait, 
+                    launch_template=launch_template, capacity=capacity,
+                    target_vcpus=target_vcpus, allocation=allocation)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    
+    for instance in instances:
+        print(f'{instance["InstanceId"]:20}{instance["State"]["Name"]:12}'
+              f'{instance.get("InstanceType", ""):12}'
+              f'{instance.get("InstanceLifecycle", "on-demand"):11}'
+              f'{instance.get("Placement", {}).get("AvailabilityZone", ""):16}'
+              f'{instance.get("PrivateIpAddress", ""):16}')
+    print(f'launched {len(instances)} instances.')
+    if not instances:
+        ctx.exit(1)
+
+
+# the states bulk actions select from unless --state is given.
+ACTION_STATES = {
+        'tag':['pending', 'running', 'stopping', 'stopped'],
+        'start':['stopped'],
+        'stop':['pending', 'running'],
+        'terminate':['pending', 'running', 'stopping', 'stopped'],
+        }
+
+def _selection_options(f):
+    # the options selecting the instances of a bulk action.
+    options = [
+        click.option(
+            '--tag',
+            'tags',
+            multiple=True,
+            help='Select instances with this tag, as key=value or key, can'
+            ' be repeated.'),
+        click.option(
+            '--state',
+            'states',
+            multiple=True,
+            type=click.Choice(['pending', 'running', 'stopping', 
+                               'stopped']),
+            help='Select instances in this state, can be repeated.'),
+        click.option(
+            '--instance-type',
+            '-t',
+            'instance_types',
+            multiple=True,
+            help='Select instances of this type, can be repeated.'),
+        click.option(
+            '--id',
+            'ids',
+            multiple=True,
+            help='Select this instance, can be repeated.'),
+        click.option(
+            '--dry-run',
+            is_flag=True,
+            default=False,
+            help='Only check the permissions for the action (the ec2 '
+            'DryRun flag), do not change the instances.'),
+        click.option(
+            '--workers',
+            '-w',
+            default=8,
+            type=click.IntRange(min=1),
+            help='Number of batches (of 1000 instances) in parallel.'),
+        ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+def _bulk(ctx, action, tag_filters, states, instance_types, ids, dry_run, 
+          confirm, **kwargs):
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
+    region = ctx.obj['region']
+    
+    if not (tag_filters or states or instance_types or ids):
+        msg = 'select the instances with --tag, --state, --instance-type '
+        msg = msg + 'or --id.'
+        raise click.UsageError(msg)
+    
+    from piggin.ec2.ec2 import AwsEC2
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        ec2 = AwsEC2(access_key, secret_key, profile_name, region,
+                     cache=ctx.obj['cache'])
+        rows = ec2.ls(states=states or ACTION_STATES[action], 
+                      tags=_parse_tags(tag_filters), 
+                      instance_types=instance_types, ids=ids, cached=False)
+        if rows is None:
+            ctx.exit(1)
+        if not rows:
+            print('no instances selected.')
+            return
+        
+        for row in rows:
+            print(f'{row["id"]:21}{row["name"][:19]:20}{row["state"]:14}'
+                  f'{row["type"]:12}')
+        if confirm and not dry_run:
+            msg = f'are you sure to {action} {len(rows)} instances'
+            if not confirm_action(msg):
+                return
         
-        msg = f'{"instance id":20}'
-        msg = f'{"instance name":20}'
-        msg = msg + f'{"instance_type":12}'
-        msg = msg + f'{"key_name":20}'
-        msg = msg + f'{"private_ip_address":16}'
-        msg = msg + f'{"public_dns_name":25}'
-        print(msg)
-        print('_'*115)
-        for instance in instances:
-            msg = f'{instance.id:20}'
-            msg = f'{instance.tags[0].get("Value"):20}'
-            msg = msg + f'{instance.instance_type:12}'
-            msg = msg + f'{instance.key_name:20}'
-            msg = msg + f'{instance.private_ip_address:16}'
-            msg = msg + f'{instance.public_dns_name:25}'
-            print(msg)
-            count += 1
+        done = getattr(ec2, action)([r['id'] for r in rows], 
+                                    dry_run=dry_run, **kwargs)
+    
+    suffix = ' (dry run)' if dry_run else ''
+    print(f'{action}: {len(done)} of {len(rows)} instances done{suffix}.')
+    if len(done) < len(rows):
+        ctx.exit(1)
+
+@ec2.command(context_settings=CONTEXT_SETTINGS)
+@_selection_options
+@click.option(
+    '--add',
+    default=None,
+    help='Tags to set, as key=value pairs separated by commas, or a json '
+    'file.')
+@click.option(
+    '--remove',
+    default=None,
+    help='Tag keys to delete, separated by commas.')
+@click.pass_context
+def tag(ctx, tags, states, instance_types, ids, dry_run, workers, add, 
+        remove):
+    """
+        set or delete tags of the selected ec2 instances.
+    """
+    if not (add or remove):
+        raise click.UsageError('give the tags to --add or --remove.')
+    try:
+        add = read_tags(add) if add else None
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    remove = [k.strip() for k in remove.split(',') if k.strip()] \
+        if remove else None
     
-    print('_'*115)
-    print(f'total running instances {count}')
\ No newline at end of file
+    _bulk(ctx, 'tag', tags, states, instance_types, ids, dry_run, False, 
+          tags=add, remove=remove, workers=workers)
+
+@ec2.command(context_settings=CONTEXT_SETTINGS)
+@_selection_options
+@click.option(
+    '--wait/--nowait',
+    default=True,
+    help='Turn on/ off waiting for the instances to be running.')
+@click.pass_context
+def start(ctx, tags, states, instance_types, ids, dry_run, workers, wait):
+    """
+        start the selected (stopped) ec2 instances.
+    """
+    _bulk(ctx, 'start', tags, states, instance_types, ids, dry_run, False, 
+          wait=wait, workers=workers)
+
+@ec2.command(context_settings=CONTEXT_SETTINGS)
+@_selection_options
+@click.option(
+    '--force',
+    is_flag=True,
+    default=False,
+    help='Force the instances to stop, without an orderly shutdown.')
+@click.option(
+    '--wait/--nowait',
+    default=True,
+    help='Turn on/ off waiting for the instances to be stopped.')
+@click.option(
+    '--yes',
+    '-y',
+    is_flag=True,
+    default=False,
+    help='Do not ask for confirmation.')
+@click.pass_context
+def stop(ctx, tags, states, instance_types, ids, dry_run, workers, force, 
+         wait, yes):
+    """
+        stop the selected (running) ec2 instances.
+    """
+    _bulk(ctx, 'stop', tags, states, instance_types, ids, dry_run, not yes, 
+          force=force, wait=wait, workers=workers)
+
+@ec2.command(context_settings=CONTEXT_SETTINGS)
+@_selection_options
+@click.option(
+    '--wait/--nowait',
+    default=False,
+    help='Turn on/ off waiting for the instances to be terminated.')
+@click.option(
+    '--yes',
+    '-y',
+    is_flag=True,
+    default=False,
+    help='Do not ask for confirmation.')
+@click.pass_context
+def rm(ctx, tags, states, instance_types, ids, dry_run, workers, wait, 
+       yes):
+    """
+        terminate the selected ec2 instances.
+    """
+    _bulk(ctx, 'terminate', tags, states, instance_types, ids, dry_run, 
+          not yes, wait=wait, workers=workers)
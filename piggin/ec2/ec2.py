@@ -12,90 +12,700 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import boto3
 import json
-import awscli
+import time
+import uuid
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
 
+from piggin.common.auth import get_session, get_client, get_resource
 from piggin.common.utils import read_tags
+from piggin.ec2.cache import InstanceCache
+
+# instance ids per DescribeInstances and DescribeInstanceStatus call.
+MAX_DESCRIBE_IDS = 1000
+MAX_STATUS_IDS = 100
+
+# instance ids per start, stop, terminate and tag call.
+MAX_ACTION_IDS = 1000
+
+# batches of a bulk action in flight at once.
+DEFAULT_WORKERS = 8
+
+# states an instance cannot reach the target state (of `_wait_for`) from.
+FAILED_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+STOP_FAILED_STATES = ('shutting-down', 'terminated')
+
+# regions listed at the same time by `ls_regions`.
+MAX_REGION_WORKERS = 32
+
+# fleet allocation strategies by capacity type, the first is the default.
+ALLOCATIONS = {'spot':['capacity-optimized', 'price-capacity-optimized', 
+                       'capacity-optimized-prioritized', 'lowest-price', 
+                       'diversified'],
+               'on-demand':['lowest-price', 'prioritized']}
+
+# fields of the instance listing, see `instance_row`.
+COLUMNS = ['id', 'name', 'state', 'type', 'key_name', 'private_ip', 
+           'public_ip', 'public_dns', 'region', 'zone', 'launch_time', 
+           'tags']
+
+def instance_row(instance, region=None):
+    """
+        flatten an instance (as returned by DescribeInstances) to the 
+        json serializable row of the listing.
+    """
+    tags = {t['Key']:t['Value'] for t in instance.get('Tags', [])}
+    launch_time = instance.get('LaunchTime')
+    return {'id':instance['InstanceId'], 
+            'name':tags.get('Name', ''),
+            'state':instance['State']['Name'],
+            'type':instance.get('InstanceType', ''),
+            'key_name':instance.get('KeyName', ''),
+            'private_ip':instance.get('PrivateIpAddress', ''),
+            'public_ip':instance.get('PublicIpAddress', ''),
+            'public_dns':instance.get('PublicDnsName', ''),
+            'region':region or '',
+            'zone':instance.get('Placement', {}).get('AvailabilityZone', ''),
+            'launch_time':launch_time.isoformat() if launch_time else '',
+            'tags':tags}
+
+def instance_filters(states=None, tags=None, instance_types=None):
+    """
+        server side DescribeInstances filters. `tags` is a dict of tag
+        values (a string or a list) by key, a value of None matches any
+        instance with the key.
+    """
+    filters = []
+    if states:
+        filters.append({'Name':'instance-state-name', 
+                        'Values':list(states)})
+    if instance_types:
+        filters.append({'Name':'instance-type', 
+                        'Values':list(instance_types)})
+    for key, value in sorted((tags or {}).items()):
+        if value is None:
+            filters.append({'Name':'tag-key', 'Values':[key]})
+        else:
+            values = [value] if isinstance(value, str) else list(value)
+            filters.append({'Name':f'tag:{key}', 'Values':values})
+    return filters
 
 class AwsEC2(object):
     
     def __init__(self, access_key=None, secret_key=None, 
-                 profile_name=None, region=None):
-        session = boto3.Session(aws_access_key_id=access_key,
-                                aws_secret_access_key=secret_key,
-                                profile_name=profile_name)
+                 profile_name=None, region=None, max_pool_connections=None,
+                 metrics=None, cache=None):
+        session = get_session(access_key, secret_key, profile_name)
+        self._account = access_key or profile_name or session.profile_name
+        self._credentials = (access_key, secret_key, profile_name)
+        self._max_pool_connections = max_pool_connections
         
-        if session.region_name is None:
-            self._default_region = region
-        else:
-            self._default_region = session.region_name
+        # an explicit region wins over that of the profile/ environment.
+        self._default_region = region or session.region_name or 'us-east-1'
+        
+        self._ec2r = get_resource(
+                'ec2', access_key, secret_key, profile_name, 
+                region_name=self._default_region,
+                max_pool_connections=max_pool_connections)
+        self._ec2c = get_client(
+                'ec2', access_key, secret_key, profile_name, 
+                region_name=self._default_region,
+                max_pool_connections=max_pool_connections)
+        
+        # optional instrumentation, see `piggin.common.metrics`.
+        self._metrics = metrics
+        if metrics:
+            metrics.register(self._ec2c)
+            metrics.register(self._ec2r.meta.client)
         
-        self._ec2r = session.resource('ec2', region_name=self._default_region)
-        self._ec2c = session.client('ec2', region_name=self._default_region)
+        # optional short lived listing cache, see `piggin.ec2.cache`.
+        if cache is True:
+            cache = InstanceCache()
+        self._cache = cache or None
+        if self._cache:
+            self._cache.register(self._ec2c)
+            self._cache.register(self._ec2r.meta.client)
         self._logger = logging.getLogger('ec2')
 
     def create_ec2(self, image_id=None, ninstance=1, key_name=None, 
                    ebs_size=None, instance_type=None, tags = None,
-                   ebs_type=None, config=None):
-        
+                   ebs_type=None, config=None, subnets=None, wait='running',
+                   launch_template=None, capacity=None, target_vcpus=None,
+                   allocation=None):
+        """
+            Launch `ninstance` instances, see `launch`, or a fleet (see 
+            `create_fleet`) if a `launch_template`, spot `capacity`, 
+            `target_vcpus` or more than one instance type (a list in 
+            `instance_type`) is given. Arguments not given are read from
+            the json `config` file if any, which may also list the 
+            `subnets` (or a single `subnet`) and the security `group`.
+        """
+        data = {}
         if config:
             with open(config) as fp:
                 data = json.load(fp)
         
-        # required options
-        image_id = image_id | data.get('image_id', None)
-        key_name = key_name | data.get('key_name', None)
-        ebs_size = ebs_size | data.get('ebs_size', None)
+        # required options, a launch template has its own.
+        image_id = image_id or data.get('image_id', None)
+        key_name = key_name or data.get('key_name', None)
+        ebs_size = ebs_size or data.get('ebs_size', None)
+        launch_template = launch_template or data.get('launch_template')
         
-        if not all([image_id, key_name, ebs_size]):
+        if not launch_template and not all([image_id, key_name, ebs_size]):
             msg = 'image_id, key_name and ebs_size must be specified.'
             raise ValueError(msg)
             
-        tags = read_tags(tags)
+        tags = read_tags(tags) if tags else data.get('tags')
         if not tags:
             msg = 'no tags specified.'
             raise ValueError(msg)
         
         # options with defaults
-        ninstance = ninstance | data.get('ninstance', 1)
-        instance_type = instance_type | data.get('instance_type', 't2.micro')
-        ebs_type = key_name | data.get('key_name', 'standard')
+        ninstance = ninstance or data.get('ninstance', 1)
+        instance_types = instance_type or data.get('instance_types') or \
+            data.get('instance_type')
+        if isinstance(instance_types, str):
+            instance_types = [instance_types]
+        instance_types = list(instance_types or [])
+        ebs_type = ebs_type or data.get('ebs_type', 'standard')
+        subnets = subnets or data.get('subnets') or (
+                [data['subnet']] if data.get('subnet') else None)
+        groups = data.get('group')
+        if isinstance(groups, str):
+            groups = [groups]
+        capacity = capacity or data.get('capacity', 'on-demand')
+        target_vcpus = target_vcpus or data.get('target_vcpus')
+        allocation = allocation or data.get('allocation')
+        
+        if launch_template or capacity == 'spot' or target_vcpus or \
+                len(instance_types) > 1:
+            return self.create_fleet(
+                    image_id, instance_types, count=ninstance, 
+                    target_vcpus=target_vcpus, subnets=subnets, 
+                    launch_template=launch_template, key_name=key_name,
+                    security_groups=groups, tags=tags, ebs_size=ebs_size,
+                    ebs_type=ebs_type, capacity=capacity, 
+                    allocation=allocation, wait=wait)
+        
+        instance_type = instance_types[0] if instance_types else 't2.micro'
+        return self.launch(
+                image_id, ninstance, instance_type=instance_type, 
+                key_name=key_name, subnets=subnets, security_groups=groups,
+                tags=tags, ebs_size=ebs_size, ebs_type=ebs_type, wait=wait)
+    
+    def vcpus(self, instance_types):
+        """
+            the default vCPU count of each of the `instance_types`.
+        """
+        response = self._ec2c.describe_instance_types(
+                InstanceTypes=list(instance_types))
+        return {t['InstanceType']:t['VCpuInfo']['DefaultVCpus']
+                for t in response['InstanceTypes']}
+    
+    def create_fleet(self, image_id=None, instance_types=None, count=None,
+                     target_vcpus=None, subnets=None, launch_template=None,
+                     key_name=None, security_groups=None, tags=None, 
+                     ebs_size=None, ebs_type='standard', capacity='spot', 
+                     allocation=None, wait='running', timeout=600, 
+                     poll_interval=5):
+        """
+            Launch instances with a single EC2 Fleet request (of type 
+            instant), from a `launch_template` (a name or an `lt-` id) or
+            from a temporary template built from the `image_id` and the 
+            other arguments, deleted once the fleet is launched. 
+            
+            Every pair of the `instance_types` and `subnets` is a pool of
+            the fleet, so a pool running short of capacity is made up 
+            from the others. The fleet asks for `count` instances or, 
+            with `target_vcpus`, for that many vCPUs with each instance 
+            type weighted by its vCPU count. `capacity` is 'spot' (with 
+            the 'capacity-optimized' `allocation` strategy by default) 
+            or 'on-demand' (with 'lowest-price'). Pools that could not 
+            be filled are logged. The instances are then waited for as 
+            in `launch`, and returned.
+        """
+        if not (count or target_vcpus):
+            raise ValueError('count or target_vcpus must be specified.')
+        instance_types = list(instance_types or [])
+        if target_vcpus and not instance_types:
+            msg = 'instance types must be specified with target_vcpus.'
+            raise ValueError(msg)
+        if not (launch_template or image_id):
+            msg = 'image_id or launch_template must be specified.'
+            raise ValueError(msg)
+        if allocation and allocation not in ALLOCATIONS[capacity]:
+            msg = f'allocation {allocation} not allowed with {capacity}.'
+            raise ValueError(msg)
         
+        tag_list = [{'Key':k, 'Value':str(v)} 
+                    for k, v in (tags or {}).items()]
+        request = {'Type':'instant', 'ClientToken':uuid.uuid4().hex,
+                   'TargetCapacitySpecification':{
+                           'TotalTargetCapacity':int(target_vcpus or count),
+                           'DefaultTargetCapacityType':capacity}}
+        allocation = allocation or ALLOCATIONS[capacity][0]
+        if capacity == 'spot':
+            request['SpotOptions'] = {'AllocationStrategy':allocation}
+        else:
+            request['OnDemandOptions'] = {'AllocationStrategy':allocation}
+        
+        created = None
+        try:
+            weights = self.vcpus(instance_types) if target_vcpus else {}
+            if launch_template:
+                key = 'LaunchTemplateId' if launch_template.startswith(
+                        'lt-') else 'LaunchTemplateName'
+                template = {key:launch_template, 'Version':'$Default'}
+                if tag_list:
+                    request['TagSpecifications'] = [
+                            {'ResourceType':'instance', 'Tags':tag_list}]
+            else:
+                created = self._create_template(
+                        image_id, key_name, security_groups, tag_list, 
+                        ebs_size, ebs_type)
+                template = {'LaunchTemplateId':created, 'Version':'$Latest'}
+            
+            overrides = []
+            for instance_type in instance_types or [None]:
+                for subnet in subnets or [None]:
+                    override = {}
+                    if instance_type:
+                        override['InstanceType'] = instance_type
+                    if subnet:
+                        override['SubnetId'] = subnet
+                    if target_vcpus:
+                        override['WeightedCapacity'] = float(
+                                weights[instance_type])
+                    if override:
+                        overrides.append(override)
+            config = {'LaunchTemplateSpecification':template}
+            if overrides:
+                config['Overrides'] = overrides
+            request['LaunchTemplateConfigs'] = [config]
+            
+            response = self._ec2c.create_fleet(**request)
+        except Exception as e:
+            self._logger.error('launching fleet:'+str(e))
+            return []
+        finally:
+            if created:
+                self._delete_template(created)
+        
+        for error in response.get('Errors', []):
+            pool = error.get('LaunchTemplateAndOverrides', {}).get(
+                    'Overrides', {})
+            self._logger.error(f'fleet pool {pool}:'
+                               f'{error.get("ErrorMessage")}')
+        
+        ids = []
+        launched = 0
+        for group in response.get('Instances', []):
+            ids.extend(group['InstanceIds'])
+            weight = group.get('LaunchTemplateAndOverrides', {}).get(
+                    'Overrides', {}).get('WeightedCapacity', 1)
+            launched += weight*len(group['InstanceIds'])
+        target = target_vcpus or count
+        if launched < target:
+            unit = 'vCPUs' if target_vcpus else 'instances'
+            msg = f'launched {launched:g} of {target} {unit}.'
+            self._logger.error(msg)
+        
+        if not ids:
+            return []
+        if wait == 'none':
+            return self._describe(ids)
+        try:
+            return self._wait_for(ids, wait, timeout, poll_interval)
+        except Exception as e:
+            self._logger.error('waiting for instances:'+str(e))
+            return self._describe(ids)
+    
+    def _create_template(self, image_id, key_name, security_groups, 
+                         tag_list, ebs_size, ebs_type):
+        data = {'ImageId':image_id}
+        if key_name:
+            data['KeyName'] = key_name
+        if security_groups:
+            data['SecurityGroupIds'] = list(security_groups)
+        if tag_list:
+            data['TagSpecifications'] = [
+                    {'ResourceType':'instance', 'Tags':tag_list},
+                    {'ResourceType':'volume', 'Tags':tag_list}]
+        if ebs_size:
+            data['BlockDeviceMappings'] = [
+                    {'DeviceName': '/dev/sda1', 
+                     'Ebs': {'VolumeSize': int(ebs_size),
+                             'VolumeType': ebs_type}}]
+        response = self._ec2c.create_launch_template(
+                LaunchTemplateName=f'piggin-{uuid.uuid4().hex}',
+                LaunchTemplateData=data)
+        return response['LaunchTemplate']['LaunchTemplateId']
+    
+    def _delete_template(self, template_id):
         try:
-            ins = self._ec2r.create_instances(
-                    ImageId=image_id,
-                    MinCount=1,
-                    MaxCount=ninstance,
-                    InstanceType=instance_type,
-                    KeyName=key_name,
-                    NetworkInterfaces=[
-                            {'SubnetId': data['subnet'],
-                             'DeviceIndex': 0,
-                             'AssociatePublicIpAddress': True,
-                             'Groups': data['group']}
-                            ],
-                    BlockDeviceMappings=[
-                            {'DeviceName': '/dev/sda1', 
-                             'Ebs': {'VolumeSize': ebs_size,
-                                     'VolumeType': ebs_type}}
-                            ]
-                    )
+            self._ec2c.delete_launch_template(LaunchTemplateId=template_id)
         except Exception as e:
-            raise e
+            msg = f'deleting launch template {template_id}:'+str(e)
+            self._logger.error(msg)
+        
+    def launch(self, image_id, count, instance_type='t2.micro', 
+               key_name=None, subnets=None, zones=None, 
+               security_groups=None, tags=None, ebs_size=None, 
+               ebs_type='standard', public_ip=True, user_data=None,
+               wait='running', timeout=600, poll_interval=5):
+        """
+            Launch a fleet of `count` instances, spread evenly across the 
+            `subnets` (or availability `zones`) with one RunInstances 
+            call per target, all in flight at once. Each call launches 
+            its share in full or fails, e.g. for insufficient capacity in
+            a zone, in which case the share is moved to the targets that 
+            succeeded. `tags` (a dict) are applied to the instances 
+            and their volumes at launch. All instances are then polled 
+            together with batched DescribeInstances calls until they 
+            reach the `wait` level: 'none' returns right after launch, 
+            'running' once all are running and 'ok' once their status 
+            checks pass. Returns the list of instances (as returned by 
+            DescribeInstances).
+        """
+        targets = [{'subnet':s} for s in subnets or []]
+        targets += [{'zone':z} for z in zones or []]
+        targets = targets or [{}]
+        
+        kwargs = {'ImageId':image_id, 'InstanceType':instance_type}
+        if key_name:
+            kwargs['KeyName'] = key_name
+        if user_data:
+            kwargs['UserData'] = user_data
+        if tags:
+            tags = [{'Key':k, 'Value':str(v)} for k, v in tags.items()]
+            kwargs['TagSpecifications'] = [
+                    {'ResourceType':'instance', 'Tags':tags},
+                    {'ResourceType':'volume', 'Tags':tags}]
+        if ebs_size:
+            kwargs['BlockDeviceMappings'] = [
+                    {'DeviceName': '/dev/sda1', 
+                     'Ebs': {'VolumeSize': int(ebs_size),
+                             'VolumeType': ebs_type}}]
+        if security_groups and not subnets:
+            kwargs['SecurityGroupIds'] = list(security_groups)
         
         try:
-            ins[0].wait_until_running()
+            instances = self._launch(
+                    kwargs, targets, count, security_groups, public_ip)
         except Exception as e:
-            raise e
+            self._logger.error('launching instances:'+str(e))
+            return []
         
+        if wait == 'none' or not instances:
+            return instances
+        
+        ids = [i['InstanceId'] for i in instances]
         try:
-            tagname=ins[0].id
-            self._ec2r.create_tags(Resources=[tagname], Tags=[tags])
+            return self._wait_for(ids, wait, timeout, poll_interval)
         except Exception as e:
-            raise e
+            self._logger.error('waiting for instances:'+str(e))
+            return instances
+        
+    def _launch(self, kwargs, targets, count, security_groups, public_ip):
+        token = uuid.uuid4().hex
+        instances = []
+        errors = []
+        
+        def run(i, target, n):
+            request = dict(kwargs, MinCount=n, MaxCount=n,
+                           ClientToken=f'{token}-{i}')
+            if 'subnet' in target:
+                interface = {'SubnetId':target['subnet'], 'DeviceIndex':0,
+                             'AssociatePublicIpAddress':public_ip}
+                if security_groups:
+                    interface['Groups'] = list(security_groups)
+                request['NetworkInterfaces'] = [interface]
+            if 'zone' in target:
+                request['Placement'] = {'AvailabilityZone':target['zone']}
+            return self._ec2c.run_instances(**request)['Instances']
+        
+        pending = count
+        healthy = list(range(len(targets)))
+        calls = 0
+        # every round but the last drops at least one target.
+        for _ in range(len(targets)):
+            if pending <= 0 or not healthy:
+                break
+            shares = [pending//len(healthy) + (1 if j < pending%len(
+                    healthy) else 0) for j in range(len(healthy))]
+            jobs = [(t, n) for t, n in zip(healthy, shares) if n]
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                futures = [(t, executor.submit(run, calls+k, targets[t], n))
+                           for k, (t, n) in enumerate(jobs)]
+            calls += len(jobs)
             
-    def ls(self):
-        instances = self._ec2r.instances.filter(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+            for t, future in futures:
+                try:
+                    result = future.result()
+                    instances.extend(result)
+                    pending -= len(result)
+                except Exception as e:
+                    # move the share of this target to the others.
+                    errors.append(e)
+                    healthy.remove(t)
+                    self._logger.error(f'launching in {targets[t]}:'+str(e))
+        
+        if not instances and errors:
+            raise errors[0]
+        if pending > 0:
+            msg = f'launched {count-pending} of {count} instances.'
+            self._logger.error(msg)
         return instances
+    
+    def _describe(self, ids):
+        """
+            describe instances by id, with up to 1000 ids per call. Ids 
+            not yet visible (eventual consistency) are left out.
+        """
+        instances = []
+        for i in range(0, len(ids), MAX_DESCRIBE_IDS):
+            batch = ids[i:i+MAX_DESCRIBE_IDS]
+            try:
+                pages = self._ec2c.get_paginator(
+                        'describe_instances').paginate(InstanceIds=batch)
+                for page in pages:
+                    for reservation in page['Reservations']:
+                        instances.extend(reservation['Instances'])
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code != 'InvalidInstanceID.NotFound':
+                    raise
+        return instances
+    
+    def _status_ok(self, ids):
+        ok = set()
+        for i in range(0, len(ids), MAX_STATUS_IDS):
+            response = self._ec2c.describe_instance_status(
+                    InstanceIds=ids[i:i+MAX_STATUS_IDS])
+            for status in response['InstanceStatuses']:
+                if status['InstanceStatus']['Status'] == 'ok' and \
+                        status['SystemStatus']['Status'] == 'ok':
+                    ok.add(status['InstanceId'])
+        return ok
+    
+    def _wait_for(self, ids, level, timeout, poll_interval):
+        """
+            poll the instances until all have reached the `level` state 
+            ('running', 'stopped' or 'terminated', or 'ok' for running 
+            with passing status checks) or cannot reach it any more, 
+            with one batched call per poll for all of them.
+        """
+        target = 'running' if level == 'ok' else level
+        failed_states = {'running':FAILED_STATES, 
+                         'stopped':STOP_FAILED_STATES}.get(target, ())
+        # terminated instances eventually drop out of the listing.
+        missing = target if target == 'terminated' else None
+        
+        deadline = time.time() + timeout
+        while True:
+            instances = self._describe(ids)
+            states = {i['InstanceId']:i['State']['Name'] for i in instances}
+            failed = [i for i, s in states.items() if s in failed_states]
+            waiting = [i for i in ids if states.get(i, missing) != target
+                       and i not in failed]
+            if not waiting and level == 'ok':
+                running = [i for i in ids if i not in failed]
+                waiting = [i for i in running 
+                           if i not in self._status_ok(running)]
+            
+            if not waiting:
+                if failed:
+                    msg = f'instances failed to reach {target} {failed}.'
+                    self._logger.error(msg)
+                return instances
+            if time.time() > deadline:
+                msg = f'timed out waiting for {len(waiting)} instances.'
+                self._logger.error(msg)
+                return instances
+            time.sleep(poll_interval)
+    
+    def _batched(self, operation, ids, id_param='InstanceIds', 
+                 dry_run=False, workers=None, **kwargs):
+        """
+            call `operation` on the `ids` in batches of up to 1000, with 
+            the batches in flight at once. With `dry_run` the calls only
+            check the permissions (the DryRun flag of ec2), and a batch
+            that would have succeeded counts as done. Returns the ids 
+            done, failures are logged.
+        """
+        batches = [ids[i:i+MAX_ACTION_IDS] 
+                   for i in range(0, len(ids), MAX_ACTION_IDS)]
+        if not batches:
+            return []
+        method = getattr(self._ec2c, operation)
+        
+        def run(batch):
+            try:
+                method(**{id_param:batch}, DryRun=dry_run, **kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if not (dry_run and code == 'DryRunOperation'):
+                    raise
+            return batch
+        
+        done = []
+        workers = min(workers or DEFAULT_WORKERS, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, b) for b in batches]
+            for future in futures:
+                try:
+                    done.extend(future.result())
+                except Exception as e:
+                    self._logger.error(f'{operation}:'+str(e))
+        return done
+    
+    def start(self, ids, dry_run=False, wait=True, timeout=600, 
+              poll_interval=5, workers=None):
+        """
+            start instances, in concurrent batches (see `_batched`), and
+            wait until they are running unless `wait` is False. Returns
+            the ids started.
+        """
+        done = self._batched('start_instances', list(ids), dry_run=dry_run,
+                             workers=workers)
+        if wait and done and not dry_run:
+            self._wait_for(done, 'running', timeout, poll_interval)
+        return done
+    
+    def stop(self, ids, force=False, dry_run=False, wait=True, timeout=600,
+             poll_interval=5, workers=None):
+        """
+            stop instances, in concurrent batches (see `_batched`), and 
+            wait until they are stopped unless `wait` is False. Returns
+            the ids stopped.
+        """
+        done = self._batched('stop_instances', list(ids), dry_run=dry_run,
+                             workers=workers, Force=force)
+        if wait and done and not dry_run:
+            self._wait_for(done, 'stopped', timeout, poll_interval)
+        return done
+    
+    def terminate(self, ids, dry_run=False, wait=True, timeout=600, 
+                  poll_interval=5, workers=None):
+        """
+            terminate instances, in concurrent batches (see `_batched`),
+            and wait until they are terminated unless `wait` is False. 
+            Returns the ids terminated.
+        """
+        done = self._batched('terminate_instances', list(ids), 
+                             dry_run=dry_run, workers=workers)
+        if wait and done and not dry_run:
+            self._wait_for(done, 'terminated', timeout, poll_interval)
+        return done
+    
+    def tag(self, ids, tags=None, remove=None, dry_run=False, 
+            workers=None):
+        """
+            set the `tags` (a dict) and delete the tag keys in `remove` 
+            on instances, in concurrent batches (see `_batched`). Returns
+            the ids done.
+        """
+        done = list(ids)
+        if tags:
+            tags = [{'Key':k, 'Value':str(v)} for k, v in tags.items()]
+            done = self._batched('create_tags', done, 'Resources', 
+                                 dry_run=dry_run, workers=workers, 
+                                 Tags=tags)
+        if remove:
+            done = self._batched('delete_tags', done, 'Resources', 
+                                 dry_run=dry_run, workers=workers,
+                                 Tags=[{'Key':k} for k in remove])
+        return done
+    
+    def regions(self):
+        """
+            the names of the regions enabled for the account.
+        """
+        response = self._ec2c.describe_regions()
+        return sorted(r['RegionName'] for r in response['Regions'])
+    
+    def _client_for(self, region):
+        # clients of other regions come from the same cached session.
+        if not region or region == self._default_region:
+            return self._ec2c
+        
+        client = get_client(
+                'ec2', *self._credentials, region_name=region,
+                max_pool_connections=self._max_pool_connections)
+        if self._metrics:
+            self._metrics.register(client)
+        if self._cache:
+            self._cache.register(client)
+        return client
+        
+    def ls(self, states=None, tags=None, instance_types=None, ids=None,
+           cached=True, region=None):
+        """
+            List the instances matching the `states`, `tags` and 
+            `instance_types` (see `instance_filters`) or `ids`, all 
+            instances by default, in `region` (the default region if 
+            None). The filters are applied server side and all fields 
+            are fetched in the paginated DescribeInstances calls, with 
+            1000 instances per page. Returns a list of rows (see 
+            `instance_row`), from the cache if there is a fresh listing 
+            and `cached` is True, or None on failure.
+        """
+        region = region or self._default_region
+        filters = instance_filters(states, tags, instance_types)
+        ids = sorted(ids or [])
+        cache = self._cache if cached else None
+        key = None
+        if cache:
+            key = cache.key(self._account, region, [filters, ids])
+            rows = cache.get(key)
+            if rows is not None:
+                return rows
+        
+        kwargs = {'Filters':filters}
+        if ids:
+            # page sizes cannot be combined with instance ids.
+            kwargs['InstanceIds'] = ids
+        else:
+            kwargs['PaginationConfig'] = {'PageSize':MAX_DESCRIBE_IDS}
+        
+        rows = []
+        try:
+            pages = self._client_for(region).get_paginator(
+                    'describe_instances').paginate(**kwargs)
+            for page in pages:
+                for reservation in page['Reservations']:
+                    rows.extend(instance_row(i, region) 
+                                for i in reservation['Instances'])
+        except Exception as e:
+            self._logger.error(f'listing instances in {region}:'+str(e))
+            return None
+        
+        if cache:
+            cache.put(key, region, rows)
+        return rows
+    
+    def ls_regions(self, regions=None, workers=None, **kwargs):
+        """
+            List the instances of several `regions` (all enabled regions
+            if None) at the same time, see `ls` for the other arguments. 
+            Yields a tuple of the region, its rows (None on failure) and
+            the seconds its listing took, as each region completes, so 
+            the whole inventory takes about as long as the slowest 
+            region.
+        """
+        regions = list(regions or self.regions())
+        if not regions:
+            return
+        workers = min(workers or MAX_REGION_WORKERS, len(regions))
+        
+        def run(region):
+            start = time.perf_counter()
+            rows = self.ls(region=region, **kwargs)
+            return region, rows, time.perf_counter() - start
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, r) for r in regions]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,312 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import asyncio
+import logging
+
+from botocore.exceptions import ClientError
+
+try:
+    from aiobotocore.session import get_session as get_aio_session
+    from aiobotocore.config import AioConfig
+except ImportError:
+    get_aio_session = None
+
+from piggin.s3.transfer import DEFAULT_PART_SIZE
+
+DEFAULT_MAX_INFLIGHT = 256
+CHUNK_SIZE = 1024*1024
+MAX_DELETE_KEYS = 1000
+
+class _TooLarge(Exception):
+    # an object above the size limit of single request transfers.
+    pass
+
+class AsyncS3(object):
+    '''
+        asyncio backend for s3 operations, built on aiobotocore. All
+        requests share a single client and connection pool, and at most
+        `max_inflight` requests are in flight at a time. This suits
+        many small objects, where a thread per request is the
+        bottleneck. Large objects are better served by the multipart
+        and ranged transfers in `AwsS3`: `transfer` leaves objects above
+        `max_size` bytes to a blocking `fallback` (see `transfer_many`).
+        File IO runs in the default executor, off the event loop.
+
+        Use as an async context manager:
+
+            async with AsyncS3() as s3:
+                data = await s3.get('bucket', 'key')
+    '''
+
+    def __init__(self, access_key=None, secret_key=None, profile_name=None,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, max_size=None):
+        if get_aio_session is None:
+            msg = 'the async backend requires aiobotocore, install it '
+            msg = msg + 'with `pip install piggin[async]`.'
+            raise ImportError(msg)
+
+        self._session = get_aio_session()
+        if profile_name:
+            self._session.set_config_variable('profile', profile_name)
+        if access_key and secret_key:
+            self._session.set_credentials(access_key, secret_key)
+
+        self._max_inflight = max_inflight
+        self._max_size = max_size or DEFAULT_PART_SIZE
+        self._semaphore = None
+        self._client = None
+        self._client_ctx = None
+        self._logger = logging.getLogger('s3')
+
+    async def __aenter__(self):
+        config = AioConfig(max_pool_connections=self._max_inflight)
+        self._client_ctx = self._session.create_client('s3', config=config)
+        self._client = await self._client_ctx.__aenter__()
+        self._semaphore = asyncio.Semaphore(self._max_inflight)
+        return self
+
+    async def __aexit__(self, *args):
+        await self._client_ctx.__aexit__(*args)
+        self._client = None
+        self._client_ctx = None
+
+    async def _call(self, operation, **kwargs):
+        async with self._semaphore:
+            return await getattr(self._client, operation)(**kwargs)
+
+    async def list(self, bucket, prefix='', recursive=True):
+        """
+            async generator of keys (and common prefixes if `recursive`
+            is False) under `prefix`.
+        """
+        kwargs = {'Bucket':bucket, 'Prefix':prefix}
+        if not recursive:
+            kwargs['Delimiter'] = '/'
+        paginator = self._client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(**kwargs):
+            for r in page.get('Contents', []):
+                yield r['Key']
+            for r in page.get('CommonPrefixes', []):
+                yield r['Prefix']
+
+    async def head(self, bucket, key):
+        return await self._call('head_object', Bucket=bucket, Key=key)
+
+    async def get(self, bucket, key, file_name=None, max_size=None):
+        """
+            fetch an object, returns the bytes, or writes them to
+            `file_name` if given. The file is written to a temporary 
+            file next to it and moved in place once complete, so a 
+            failed read never leaves a truncated file behind. Raises 
+            `_TooLarge` for objects larger than `max_size`, before 
+            reading them.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            response = await self._client.get_object(Bucket=bucket, Key=key)
+            async with response['Body'] as body:
+                if max_size and response['ContentLength'] > max_size:
+                    raise _TooLarge(key)
+                if file_name is None:
+                    return await body.read()
+
+                dirname = os.path.dirname(file_name)
+                if dirname:
+                    await loop.run_in_executor(
+                            None, lambda:os.makedirs(dirname, exist_ok=True))
+                fp, tmp = await loop.run_in_executor(
+                        None, _open_temp, file_name)
+                try:
+                    try:
+                        while True:
+                            chunk = await body.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            await loop.run_in_executor(None, fp.write, chunk)
+                    finally:
+                        await loop.run_in_executor(None, fp.close)
+                    await loop.run_in_executor(
+                            None, os.replace, tmp, file_name)
+                except BaseException:
+                    await loop.run_in_executor(None, _remove, tmp)
+                    raise
+
+    async def put(self, bucket, key, data=None, file_name=None, 
+                  max_size=None):
+        """
+            upload bytes `data` or the content of `file_name` to an
+            object in a single request. Raises `_TooLarge` for files 
+            larger than `max_size`, before reading them.
+        """
+        if file_name is not None:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(
+                    None, _read_file, file_name, max_size)
+        return await self._call(
+                'put_object', Bucket=bucket, Key=key, Body=data or b'')
+
+    async def copy(self, src_bucket, src_key, bucket, key):
+        """
+            server-side copy of an object in a single request. Raises 
+            `_TooLarge` if the object is over the 5GB limit of a copy.
+        """
+        source = {'Bucket':src_bucket, 'Key':src_key}
+        try:
+            return await self._call(
+                    'copy_object', Bucket=bucket, Key=key, 
+                    CopySource=source)
+        except ClientError as e:
+            # the error for sources over 5GB, which need a multipart copy.
+            if e.response.get('Error', {}).get('Code') == 'InvalidRequest':
+                raise _TooLarge(src_key)
+            raise
+
+    async def delete(self, bucket, keys):
+        """
+            delete a list of keys in concurrent batches of 1000. Returns
+            the list of errors.
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        batches = [keys[i:i+MAX_DELETE_KEYS] for i in range(
+                0, len(keys), MAX_DELETE_KEYS)]
+        responses = await asyncio.gather(*[self._call(
+                'delete_objects', Bucket=bucket,
+                Delete={'Objects':[{'Key':k} for k in batch], 'Quiet':True})
+                for batch in batches])
+        return [e for r in responses for e in r.get('Errors', [])]
+
+    async def transfer(self, src, dest, move=False):
+        """
+            copy a single file or object from `src` to `dest`, where
+            either can be an s3 path or a local path. Returns False, 
+            without copying, if the file or object is larger than 
+            `max_size` (or too large for a single copy request).
+        """
+        from piggin.s3.s3 import AwsS3
+
+        protocol1, bucket1, key1, path1 = AwsS3.parse_path(src)
+        protocol2, bucket2, key2, path2 = AwsS3.parse_path(dest)
+
+        try:
+            if protocol1 == 's3' and protocol2 == 'file':
+                await self.get(bucket1, key1, path2, max_size=self._max_size)
+            elif protocol1 == 'file' and protocol2 == 's3':
+                await self.put(bucket2, key2, file_name=path1, 
+                               max_size=self._max_size)
+            elif protocol1 == 's3' and protocol2 == 's3':
+                await self.copy(bucket1, key1, bucket2, key2)
+            else:
+                msg = 'Unknown source {} or destination {}'.format(
+                        src, dest)
+                raise ValueError(msg)
+        except _TooLarge:
+            return False
+
+        if move and protocol1 == 's3':
+            await self._call('delete_object', Bucket=bucket1, Key=key1)
+        elif move:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, os.remove, path1)
+        return True
+
+    async def transfer_many(self, pairs, move=False, verbose=False, 
+                            fallback=None):
+        """
+            run `transfer` for a (possibly blocking, e.g. a listing)
+            iterable of (source, destination) pairs, with up to
+            `max_inflight` transfers at a time. The iterable is consumed
+            in a thread, so listing overlaps with the transfers. Pairs 
+            too large for `transfer` are passed to the blocking 
+            `fallback(source, destination)` in the default executor, 
+            which is responsible for the move and the verbose output, or
+            fail if there is none. Returns a tuple of number of files 
+            transferred and list of failures.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=2*self._max_inflight)
+        failures = []
+        done = [0]
+
+        def produce():
+            try:
+                for pair in pairs:
+                    asyncio.run_coroutine_threadsafe(
+                            queue.put(pair), loop).result()
+            finally:
+                asyncio.run_coroutine_threadsafe(
+                        queue.put(None), loop).result()
+
+        async def work():
+            while True:
+                pair = await queue.get()
+                if pair is None:
+                    await queue.put(None)
+                    return
+                try:
+                    if not await self.transfer(pair[0], pair[1], move=move):
+                        if fallback is None:
+                            msg = f'{pair[0]} is too large for a single '
+                            msg = msg + 'request.'
+                            raise ValueError(msg)
+                        await loop.run_in_executor(
+                                None, fallback, pair[0], pair[1])
+                    elif verbose:
+                        action = 'moved' if move else 'copied'
+                        print(f'{action} {pair[0]} to {pair[1]}.')
+                    done[0] += 1
+                except Exception as e:
+                    failures.append((pair, e))
+                    self._logger.error(f'failed task {pair}:'+str(e))
+
+        producer = loop.run_in_executor(None, produce)
+        await asyncio.gather(*[work() for _ in range(self._max_inflight)])
+        await producer
+        return done[0], failures
+
+def _read_file(file_name, max_size=None):
+    with open(file_name, 'rb') as fp:
+        if max_size and os.fstat(fp.fileno()).st_size > max_size:
+            raise _TooLarge(file_name)
+        return fp.read()
+
+def _open_temp(file_name):
+    # in the same directory, so that the final move is a rename.
+    dirname, name = os.path.split(file_name)
+    tmp = os.path.join(dirname, f'.{name}.{os.urandom(4).hex()}.tmp')
+    return open(tmp, 'xb'), tmp
+
+def _remove(file_name):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+def run_transfers(pairs, access_key=None, secret_key=None, profile_name=None,
+                  max_inflight=DEFAULT_MAX_INFLIGHT, move=False,
+                  verbose=False, fallback=None, max_size=None):
+    """
+        blocking wrapper running `AsyncS3.transfer_many` on a new event
+        loop.
+    """
+    async def run():
+        async with AsyncS3(access_key, secret_key, profile_name,
+                           max_inflight=max_inflight,
+                           max_size=max_size) as s3:
+            return await s3.transfer_many(pairs, move=move, verbose=verbose,
+                                          fallback=fallback)
+
+    return asyncio.run(run())
@@ -0,0 +1,238 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from piggin.common.utils import register_hook
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_LISTINGS = 1000
+PAGE_SIZE = 1000
+
+# recordings never finished (e.g. by a killed process) are dropped after.
+ABANDONED_AFTER = 3600
+
+# s3 operations that change the listing of the prefixes above a key.
+MUTATING_OPERATIONS = ['PutObject', 'CompleteMultipartUpload', 'CopyObject',
+                       'DeleteObject', 'DeleteObjects', 'DeleteBucket']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    delimiter TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    used REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS listings_path
+    ON listings (bucket, prefix, delimiter);
+CREATE TABLE IF NOT EXISTS entries (
+    listing INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    modified REAL,
+    is_prefix INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_listing ON entries (listing, key);
+"""
+
+class ListingCache(object):
+    '''
+        An on-disk (sqlite) cache of s3 listings, keyed by the bucket,
+        prefix and delimiter, storing the size, etag and last modified
+        time of each key. Listings expire after `ttl` seconds, and beyond
+        `max_listings` the least recently used ones are evicted. Writes
+        through piggin invalidate the cached listings of all prefixes
+        above the affected keys.
+    '''
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL,
+                 max_listings=DEFAULT_MAX_LISTINGS):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.piggin',
+                                'cache.db')
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._path = path
+        self._ttl = ttl
+        self._max_listings = max_listings
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            # entries left behind by listings dropped mid-recording.
+            self._conn.execute(
+                    "DELETE FROM entries WHERE listing NOT IN "
+                    "(SELECT id FROM listings)")
+
+    def pages(self, bucket, prefix, delimiter):
+        """
+            return a generator of cached listing pages (in the format of
+            `list_objects_v2` responses), or None if there is no fresh
+            complete listing for the prefix.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                    "SELECT id FROM listings WHERE bucket=? AND prefix=? "
+                    "AND delimiter=? AND complete=1 AND fetched>? "
+                    "ORDER BY fetched DESC LIMIT 1",
+                    (bucket, prefix, delimiter or '', now-self._ttl)
+                    ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                    "UPDATE listings SET used=? WHERE id=?", (now, row[0]))
+
+        return self._read_pages(row[0])
+
+    def _read_pages(self, listing):
+        last = ''
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                        "SELECT key, size, etag, modified, is_prefix FROM "
+                        "entries WHERE listing=? AND key>? ORDER BY key "
+                        "LIMIT ?", (listing, last, PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+
+            last = rows[-1][0]
+            page = {'Contents':[], 'CommonPrefixes':[],
+                    'IsTruncated':len(rows) == PAGE_SIZE}
+            for key, size, etag, modified, is_prefix in rows:
+                if is_prefix:
+                    page['CommonPrefixes'].append({'Prefix':key})
+                    continue
+                page['Contents'].append({
+                        'Key':key, 'Size':size, 'ETag':etag,
+                        'LastModified':datetime.fromtimestamp(
+                                modified, tz=timezone.utc)})
+            yield page
+
+    def begin(self, bucket, prefix, delimiter):
+        """
+            start recording a listing, returns the listing id.
+        """
+        now = time.time()
+        with self._lock:
+            # drop abandoned recordings of the same listing.
+            self._delete("bucket=? AND prefix=? AND delimiter=? AND "
+                         "complete=0", (bucket, prefix, delimiter or ''))
+            cursor = self._conn.execute(
+                    "INSERT INTO listings (bucket, prefix, delimiter, "
+                    "fetched, used) VALUES (?,?,?,?,?)",
+                    (bucket, prefix, delimiter or '', now, now))
+            return cursor.lastrowid
+
+    def add(self, listing, page):
+        rows = [(listing, r['Key'], r.get('Size'), r.get('ETag'),
+                 r['LastModified'].timestamp(), 0)
+                for r in page.get('Contents', [])]
+        rows.extend([(listing, r['Prefix'], None, None, None, 1)
+                     for r in page.get('CommonPrefixes', [])])
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            # the listing may have been invalidated or evicted while 
+            # being recorded, its pages are then dropped.
+            if self._conn.execute("SELECT 1 FROM listings WHERE id=?",
+                                  (listing,)).fetchone():
+                self._conn.executemany(
+                        "INSERT INTO entries VALUES (?,?,?,?,?,?)", rows)
+            self._conn.execute('COMMIT')
+
+    def finish(self, listing):
+        """
+            mark a recorded listing complete, replacing older listings of
+            the same prefix, and evict expired and excess listings.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                    "SELECT bucket, prefix, delimiter FROM listings WHERE "
+                    "id=?", (listing,)).fetchone()
+            if row is None:
+                # invalidated while being recorded.
+                return
+            self._delete("bucket=? AND prefix=? AND delimiter=? AND id!=?",
+                         row + (listing,))
+            self._conn.execute(
+                    "UPDATE listings SET complete=1 WHERE id=?", (listing,))
+            # recordings in progress are not expired, unless abandoned.
+            abandoned = now - max(self._ttl, ABANDONED_AFTER)
+            self._delete("(complete=1 AND fetched<?) OR fetched<?",
+                         (now-self._ttl, abandoned))
+            self._delete("id IN (SELECT id FROM listings ORDER BY used DESC "
+                         "LIMIT -1 OFFSET ?)", (self._max_listings,))
+
+    def invalidate(self, bucket, key=''):
+        """
+            drop the cached listings of all prefixes of `key`.
+        """
+        with self._lock:
+            self._delete("bucket=? AND substr(?, 1, length(prefix))=prefix",
+                         (bucket, key or ''))
+
+    def clear(self):
+        with self._lock:
+            self._delete("1=1", ())
+
+    def _delete(self, where, args):
+        # the listings and their entries go together, by listing id.
+        self._conn.execute('BEGIN IMMEDIATE')
+        ids = [r[0] for r in self._conn.execute(
+                "SELECT id FROM listings WHERE "+where, args).fetchall()]
+        if ids:
+            marks = ','.join('?'*len(ids))
+            self._conn.execute(
+                    f"DELETE FROM entries WHERE listing IN ({marks})", ids)
+            self._conn.execute(
+                    f"DELETE FROM listings WHERE id IN ({marks})", ids)
+        self._conn.execute('COMMIT')
+
+    def on_mutation(self, params, **kwargs):
+        """
+            botocore `before-parameter-build` handler to invalidate
+            listings affected by a write.
+        """
+        bucket = params.get('Bucket')
+        if not bucket:
+            return
+        keys = [params.get('Key', '')]
+        if 'Delete' in params:
+            keys = [o.get('Key', '') for o in params['Delete'].get(
+                    'Objects', [])]
+        for key in keys:
+            self.invalidate(bucket, key)
+
+    def register(self, client):
+        """
+            register invalidation hooks on an s3 client, replacing those
+            of an earlier cache on the same file.
+        """
+        for operation in MUTATING_OPERATIONS:
+            register_hook(
+                    client, f'before-parameter-build.s3.{operation}',
+                    self.on_mutation,
+                    f'piggin-cache-{self._path}-{operation}')
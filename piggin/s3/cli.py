@@ -13,9 +13,12 @@
 # limitations under the License.
 
 
+import sys
 import click
-from piggin.s3.s3 import AwsS3
-from piggin.common.types import OSEnvAwsReset
+from piggin.common.types import OSEnvAwsReset, ByteSizeType
+
+# the heavy modules (boto3 and the service wrappers) are imported
+# inside the commands on first use, see `piggin.__main__`.
 
 CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
                         allow_extra_args=True,
@@ -23,8 +26,19 @@ CONTEXT_SETTINGS = dict(ignore_unknown_options=True,
 
 
 @click.group()
+@click.option(
+    '--cache/--nocache',
+    envvar='PIGGIN_S3_CACHE',
+    default=False,
+    help='Turn on/ off the local listing cache.')
+@click.option(
+    '--cache-ttl',
+    envvar='PIGGIN_S3_CACHE_TTL',
+    default=300,
+    type=click.IntRange(min=0),
+    help='Expiry of cached listings in seconds.')
 @click.pass_context
-def s3(ctx):
+def s3(ctx, cache, cache_ttl):
     """
         piggin s3 commands to interact with AWS s3 resources.
         
@@ -35,8 +49,14 @@ def s3(ctx):
             piggin s3 rm [options] path\n
             piggin s3 mv [options] src dest\n
             piggin s3 cp [options] src dest\n
+            piggin s3 sync [options] src dest\n
+            piggin s3 cat [options] path\n
+            piggin s3 query [options] path expression\n
     """
-    pass
+    ctx.obj['cache'] = None
+    if cache:
+        from piggin.s3.cache import ListingCache
+        ctx.obj['cache'] = ListingCache(ttl=cache_ttl)
 
 @s3.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('path', default='s3:///')
@@ -44,8 +64,39 @@ def s3(ctx):
     '--verbose/--silent',
     default=False,
     help='Turn on/ off verbosity. [verbose/silent]')
+@click.option(
+    '--max-keys',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Maximum number of keys to list.')
+@click.option(
+    '--page-size',
+    default=None,
+    type=click.IntRange(min=1, max=1000),
+    help='Number of keys to fetch per list request.')
+@click.option(
+    '--recursive/--norecursive',
+    '-r',
+    default=False,
+    help='Turn on/ off recursive listing.')
+@click.option(
+    '--workers',
+    '-w',
+    default=1,
+    type=click.IntRange(min=1),
+    help='Number of parallel listing threads for recursive listing.')
+@click.option(
+    '--pattern',
+    default=None,
+    help='Only list keys with path (relative to the prefix) matching '
+    'pattern.')
+@click.option(
+    '--glob/--regex',
+    default=False,
+    help='Match pattern as a glob or a regex. [regex]')
 @click.pass_context
-def ls(ctx, path, verbose):
+def ls(ctx, path, verbose, max_keys, page_size, recursive, workers, pattern,
+       glob):
     """
         list s3 buckets.
     """
@@ -53,11 +104,17 @@ def ls(ctx, path, verbose):
     secret_key = ctx.obj['secret_key']
     profile_name = ctx.obj['profile_name']
     
+    from piggin.s3.s3 import AwsS3
+    
     with OSEnvAwsReset(access_key, secret_key):
-        awsS3 = AwsS3(access_key, secret_key, profile_name)
-        items = awsS3.ls(path)
+        awsS3 = AwsS3(access_key, secret_key, profile_name, 
+                      cache=ctx.obj['cache'])
+        items = awsS3.ls(path, page_size=page_size, max_keys=max_keys,
+                         recursive=recursive, workers=workers, 
+                         pattern=pattern, glob=glob)
         if items:
-            print(items)
+            for item in items:
+                print(item)
             
 @s3.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('path')
@@ -71,8 +128,34 @@ def ls(ctx, path, verbose):
     '-r',
     default=False,
     help='Turn on/ off recursive delete.')
+@click.option(
+    '--workers',
+    '-w',
+    default=8,
+    type=click.IntRange(min=1),
+    help='Number of batch deletes (of 1000 keys) in parallel.')
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='Only print the keys to delete, do not delete.')
+@click.option(
+    '--versions/--noversions',
+    default=False,
+    help='Delete all versions and delete markers of the keys. Versions '
+    'are always purged when deleting a versioned bucket.')
+@click.option(
+    '--pattern',
+    default=None,
+    help='Only delete keys with path (relative to the prefix) matching '
+    'pattern, for recursive delete.')
+@click.option(
+    '--glob/--regex',
+    default=False,
+    help='Match pattern as a glob or a regex. [regex]')
 @click.pass_context
-def rm(ctx, path, verbose, recursive):
+def rm(ctx, path, verbose, recursive, workers, dry_run, versions, pattern,
+       glob):
     """
         delete s3 buckets or keys/ objects.
     """
@@ -80,9 +163,18 @@ def rm(ctx, path, verbose, recursive):
     secret_key = ctx.obj['secret_key']
     profile_name = ctx.obj['profile_name']
     
-    with OSEnvAwsReset(access_key, secret_key, profile_name):
-        awsS3 = AwsS3(access_key, secret_key)
-        awsS3.rm(path, verbose, recursive)
+    from piggin.s3.s3 import AwsS3
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        awsS3 = AwsS3(access_key, secret_key, profile_name, 
+                      cache=ctx.obj['cache'])
+        failures = awsS3.rm(path, verbose, recursive, workers=workers, 
+                            dry_run=dry_run, versions=versions, 
+                            pattern=pattern, glob=glob)
+    
+    # None is an aborted or failed delete, a list the keys that failed.
+    if failures is None or failures:
+        ctx.exit(1)
         
 @s3.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('path')
@@ -114,8 +206,299 @@ def mkdir(ctx, path, verbose, parent, location, acl):
     secret_key = ctx.obj['secret_key']
     profile_name = ctx.obj['profile_name']
     
+    from piggin.s3.s3 import AwsS3
+    
     with OSEnvAwsReset(access_key, secret_key):
-        awsS3 = AwsS3(access_key, secret_key, profile_name)
+        awsS3 = AwsS3(access_key, secret_key, profile_name, 
+                      cache=ctx.obj['cache'])
         awsS3.mkdir(path, verbose, parent, location, acl)
+        
+def transfer_options(func):
+    """
+        options shared by the copy and move commands.
+    """
+    options = [
+        click.argument('src'),
+        click.argument('dest'),
+        click.option(
+            '--verbose/--silent',
+            '-v',
+            default=True,
+            help='Turn on/ off verbosity. [verbose/silent]'),
+        click.option(
+            '--recursive/--norecursive',
+            '-r',
+            default=False,
+            help='Turn on/ off recursive copy of directories/ prefixes.'),
+        click.option(
+            '--pattern',
+            default=None,
+            help='Only copy files with relative path matching pattern.'),
+        click.option(
+            '--glob/--regex',
+            default=False,
+            help='Match pattern as a glob or a regex. [regex]'),
+        click.option(
+            '--workers',
+            '-w',
+            default=8,
+            type=click.IntRange(min=1),
+            help='Number of files to transfer in parallel.'),
+        click.option(
+            '--part-size',
+            default=None,
+            type=ByteSizeType(),
+            help='Part size for multipart transfers, e.g. 64MB.'),
+        click.option(
+            '--concurrency',
+            '-c',
+            default=8,
+            type=click.IntRange(min=1),
+            help='Number of parts of a file to transfer in parallel.'),
+        click.option(
+            '--resume/--noresume',
+            default=True,
+            help='Turn on/ off resuming interrupted downloads.'),
+        click.option(
+            '--async',
+            'use_async',
+            is_flag=True,
+            default=False,
+            help='Use the asyncio backend, with up to workers requests in '
+            'flight. Suits many small files, requires aiobotocore.'),
+        ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+def _transfer(ctx, src, dest, verbose, recursive, pattern, glob, workers, 
+              part_size, concurrency, resume, use_async, move):
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
+    
+    if recursive and '-' in (src, dest):
+        raise click.UsageError('cannot copy recursively to or from a pipe.')
+    
+    from piggin.s3.s3 import AwsS3
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        awsS3 = AwsS3(access_key, secret_key, profile_name,
+                      max_pool_connections=max(10, workers*concurrency),
+                      cache=ctx.obj['cache'])
+        done, failures = awsS3.cp(
+                src, dest, recursive=recursive, pattern=pattern, glob=glob,
+                workers=workers, part_size=part_size, 
+                concurrency=concurrency, resume=resume, verbose=verbose,
+                move=move, use_async=use_async)
+    
+    if verbose:
+        # keep stdout clean when it carries the data.
+        out = sys.stderr if dest == '-' else sys.stdout
+        print(f'transferred {done} files, {len(failures)} failed.', 
+              file=out)
+    if failures:
+        ctx.exit(1)
+        
+@s3.command(context_settings=CONTEXT_SETTINGS)
+@transfer_options
+@click.pass_context
+def cp(ctx, src, dest, verbose, recursive, pattern, glob, workers, 
+       part_size, concurrency, resume, use_async):
+    """
+        copy files between local fs and s3, or within s3. Use - as 
+        the source or destination to stream from stdin or to stdout.
+    """
+    _transfer(ctx, src, dest, verbose, recursive, pattern, glob, workers, 
+              part_size, concurrency, resume, use_async, move=False)
+    
+@s3.command(context_settings=CONTEXT_SETTINGS)
+@transfer_options
+@click.pass_context
+def mv(ctx, src, dest, verbose, recursive, pattern, glob, workers, 
+       part_size, concurrency, resume, use_async):
+    """
+        move files between local fs and s3, or within s3.
+    """
+    _transfer(ctx, src, dest, verbose, recursive, pattern, glob, workers, 
+              part_size, concurrency, resume, use_async, move=True)
+    
+@s3.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('src')
+@click.argument('dest')
+@click.option(
+    '--verbose/--silent',
+    '-v',
+    default=True,
+    help='Turn on/ off verbosity. [verbose/silent]')
+@click.option(
+    '--delete/--nodelete',
+    default=False,
+    help='Delete files at destination that are not in the source.')
+@click.option(
+    '--checksum/--nochecksum',
+    default=False,
+    help='Compare etag/ md5 instead of modification time.')
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='Only print the actions, do not copy or delete.')
+@click.option(
+    '--pattern',
+    default=None,
+    help='Only sync files with relative path matching pattern.')
+@click.option(
+    '--glob/--regex',
+    default=False,
+    help='Match pattern as a glob or a regex. [regex]')
+@click.option(
+    '--workers',
+    '-w',
+    default=8,
+    type=click.IntRange(min=1),
+    help='Number of files to transfer in parallel.')
+@click.option(
+    '--part-size',
+    default=None,
+    type=ByteSizeType(),
+    help='Part size for multipart transfers, e.g. 64MB.')
+@click.option(
+    '--concurrency',
+    '-c',
+    default=8,
+    type=click.IntRange(min=1),
+    help='Number of parts of a file to transfer in parallel.')
+@click.pass_context
+def sync(ctx, src, dest, verbose, delete, checksum, dry_run, pattern, glob,
+         workers, part_size, concurrency):
+    """
+        sync directories/ prefixes, copying only the changes.
+    """
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
     
+    if '-' in (src, dest):
+        raise click.UsageError('cannot sync to or from a pipe.')
+    
+    from piggin.s3.s3 import AwsS3
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        awsS3 = AwsS3(access_key, secret_key, profile_name,
+                      max_pool_connections=max(10, workers*concurrency),
+                      cache=ctx.obj['cache'])
+        done, failures = awsS3.sync(
+                src, dest, delete=delete, checksum=checksum, 
+                dry_run=dry_run, pattern=pattern, glob=glob, 
+                workers=workers, part_size=part_size, 
+                concurrency=concurrency, verbose=verbose)
+    
+    if verbose:
+        print(f'synced {done} files, {len(failures)} failed.')
+    if failures:
+        ctx.exit(1)
 
+@s3.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('path')
+@click.option(
+    '--decompress/--nodecompress',
+    '-z',
+    default=False,
+    help='Turn on/ off decompressing gzip and bzip2 objects.')
+@click.pass_context
+def cat(ctx, path, decompress):
+    """
+        write an s3 object to stdout.
+    """
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
+    
+    from piggin.s3.s3 import AwsS3
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        awsS3 = AwsS3(access_key, secret_key, profile_name)
+        protocol, bucket, key, _ = awsS3.parse_path(path)
+        if protocol != 's3':
+            raise click.BadParameter(f'not an s3 path {path}.')
+        done = awsS3.cat(bucket, key, decompress=decompress)
+    
+    if not done:
+        ctx.exit(1)
+
+@s3.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('path')
+@click.argument('expression')
+@click.option(
+    '--input-format',
+    default=None,
+    type=click.Choice(['csv', 'json']),
+    help='Format of the object, json for json lines. Guessed from the '
+    'key by default.')
+@click.option(
+    '--compression',
+    default=None,
+    type=click.Choice(['none', 'gzip', 'bzip2']),
+    help='Compression of the object. Guessed from the key by default.')
+@click.option(
+    '--header/--noheader',
+    default=True,
+    help='Turn on/ off using the first line of csv objects as the column '
+    'names, columns are _1, _2, ... without.')
+@click.option(
+    '--delimiter',
+    default=',',
+    help='Field delimiter of csv objects.')
+@click.option(
+    '--output-format',
+    default=None,
+    type=click.Choice(['csv', 'json']),
+    help='Format of the output records. Same as the input by default.')
+@click.option(
+    '--output',
+    '-o',
+    default='-',
+    type=click.File('wb'),
+    help='File to write the records to. [stdout]')
+@click.option(
+    '--engine',
+    default='auto',
+    type=click.Choice(['auto', 's3', 'local']),
+    help='Run the query with s3 select, locally on a streamed read, or '
+    'with s3 select falling back to local. [auto]')
+@click.option(
+    '--verbose/--silent',
+    '-v',
+    default=False,
+    help='Turn on/ off printing scan statistics to stderr. [silent]')
+@click.pass_context
+def query(ctx, path, expression, input_format, compression, header, 
+          delimiter, output_format, output, engine, verbose):
+    """
+        filter a csv or json lines s3 object with an s3 select sql 
+        expression, e.g. "SELECT s.name FROM S3Object s WHERE s.id = '3'".
+    """
+    access_key = ctx.obj['access_key']
+    secret_key = ctx.obj['secret_key']
+    profile_name = ctx.obj['profile_name']
+    
+    from piggin.s3.s3 import AwsS3
+    
+    with OSEnvAwsReset(access_key, secret_key):
+        awsS3 = AwsS3(access_key, secret_key, profile_name)
+        protocol, bucket, key, _ = awsS3.parse_path(path)
+        if protocol != 's3':
+            raise click.BadParameter(f'not an s3 path {path}.')
+        stats = awsS3.query(
+                bucket, key, expression, fp=output, 
+                input_format=input_format, 
+                compression=compression.upper() if compression else None,
+                header=header, delimiter=delimiter, 
+                output_format=output_format, engine=engine)
+    
+    if stats is None:
+        ctx.exit(1)
+    if verbose:
+        print(', '.join(f'{k} {v}' for k, v in stats.items()), 
+              file=sys.stderr)
@@ -0,0 +1,321 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+from collections import deque
+
+GLOB_META = '*?['
+REGEX_META = set('.^$*+?{}[]|()\\')
+
+def glob_to_regex(pattern):
+    """
+        translate a path glob to a regex. `*` and `?` do not match `/`,
+        `**` matches across directories, and `[...]` is a character
+        class (negated with `!`).
+    """
+    i, n, out = 0, len(pattern), []
+    while i < n:
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i+1 if pattern[i:i+1] in ('!', ']') else i)
+            if j < 0:
+                out.append(re.escape(c))
+                continue
+            body = pattern[i:j].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body + ']')
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return '(?s:' + ''.join(out) + r')\Z'
+
+def glob_prefix(pattern):
+    """
+        the literal part of a glob before its first wildcard.
+    """
+    for i, c in enumerate(pattern):
+        if c in GLOB_META:
+            return pattern[:i]
+    return pattern
+
+def regex_prefix(pattern):
+    """
+        the literal prefix every match of an anchored (`^` or `\\A`)
+        regex must start with, or '' if there is none.
+    """
+    if '|' in pattern:
+        # alternatives may not share the prefix.
+        return ''
+    if pattern.startswith('^'):
+        i = 1
+    elif pattern.startswith('\\A'):
+        i = 2
+    else:
+        return ''
+
+    out = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            literal = pattern[i+1:i+2]
+            if not literal or literal.isalnum():
+                # a class (\d, \w, ...) or an escape sequence.
+                break
+            step = 2
+        elif c in REGEX_META:
+            break
+        else:
+            literal, step = c, 1
+        if pattern[i+step:i+step+1] in ('*', '?', '{'):
+            # the character is optional or repeated.
+            break
+        out.append(literal)
+        i += step
+    return ''.join(out)
+
+class KeyFilter(object):
+    '''
+        A compiled glob or regex pattern on the keys under a root prefix,
+        matched against the path relative to the root. Regexes are
+        searched, as with `re.search`. Globs match the whole path with
+        `/` as the separator (see `glob_to_regex`); a glob without a `/`
+        matches the last path component instead, like `find -name`.
+
+        Besides matching, the filter tells the listing how to narrow it:
+        `prefix` is the literal start all matches share (for anchored
+        regexes and path globs), to be appended to the listing prefix,
+        and `can_descend` tells if a directory can hold any match, so a
+        delimited listing can skip the subtrees that cannot. `prunes` is
+        True if such a walk is worth it over a flat listing.
+    '''
+
+    def __init__(self, pattern, glob=False, basename=None):
+        self.pattern = pattern
+        self.glob = glob
+        if basename is None:
+            basename = glob and '/' not in pattern
+        self.basename = basename
+
+        if glob:
+            self._regex = re.compile(glob_to_regex(pattern))
+            self._match = self._regex.match
+            self.prefix = '' if basename else glob_prefix(pattern)
+        else:
+            self._regex = re.compile(pattern)
+            self._match = self._regex.search
+            self.prefix = regex_prefix(pattern)
+
+        self._segments = []
+        self.prunes = False
+        if glob and not basename:
+            self._segments = [
+                    None if '**' in s else re.compile(glob_to_regex(s))
+                    for s in pattern.split('/')]
+            # a walk pays off unless the first wildcard already spans
+            # directories.
+            depth = self.prefix.count('/')
+            self.prunes = self.prefix != pattern and \
+                self._segments[depth] is not None
+
+    def __repr__(self):
+        kind = 'glob' if self.glob else 'regex'
+        return f'KeyFilter({kind} {self.pattern!r})'
+
+    def match(self, rel):
+        if self.basename:
+            rel = rel.rstrip('/').split('/')[-1]
+        return self._match(rel) is not None
+
+    __call__ = match
+
+    def can_descend(self, rel):
+        """
+            if the directory `rel` (relative to the root, ending with a
+            `/`) can contain a match.
+        """
+        if self.basename:
+            return True
+        if not (rel.startswith(self.prefix) or self.prefix.startswith(rel)):
+            return False
+        if not self._segments:
+            return True
+
+        for i, name in enumerate(rel.rstrip('/').split('/')):
+            if i < len(self._segments) and self._segments[i] is None:
+                return True
+            if i >= len(self._segments) - 1:
+                # the pattern ends above this depth.
+                return False
+            if not self._segments[i].match(name):
+                return False
+        return True
+
+class AhoCorasick(object):
+    '''
+        Aho-Corasick automaton finding which of a set of literal words
+        occur in a text, in a single scan of the text whatever the
+        number of words.
+    '''
+
+    def __init__(self, words):
+        # `words` is a list of (word, value), the values of the words
+        # found are returned by `search`.
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word, value in words:
+            node = 0
+            for c in word:
+                child = self._goto[node].get(c)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][c] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = child
+            self._out[node].append(value)
+
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for c, child in self._goto[node].items():
+                pending.append(child)
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(c, 0)
+                self._out[child] = self._out[child] + \
+                    self._out[self._fail[child]]
+
+    def search(self, text):
+        found = set()
+        node = 0
+        for c in text:
+            while node and c not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(c, 0)
+            if self._out[node]:
+                found.update(self._out[node])
+        return found
+
+class KeyRouter(object):
+    '''
+        Routes keys to the (indices of the) filters they match, to fan
+        out a single listing to several destinations. Literal regexes
+        are found together with an Aho-Corasick automaton, literal globs
+        with a lookup, and the remaining patterns are tried only if a
+        combined regex of all of them matches. Regexes with groups are
+        left out of the combined regex and always tried. Filters on names and on
+        paths are planned separately.
+
+        The router can stand in for a `KeyFilter` in the listing: it
+        matches if any filter does, and narrows the listing to what the
+        filters have in common.
+    '''
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.basename = all(f.basename for f in self.filters)
+        self.prunes = all(f.prunes for f in self.filters)
+        self.prefix = ''
+        if self.basename or not any(f.basename for f in self.filters):
+            self.prefix = os.path.commonprefix(
+                    [f.prefix for f in self.filters])
+
+        self._plans = []
+        for basename in (True, False):
+            group = [(i, f) for i, f in enumerate(self.filters)
+                     if f.basename == basename]
+            if group:
+                self._plans.append((basename,) + self._plan(group))
+        self._last = (None, [])
+
+    @classmethod
+    def _plan(cls, group):
+        literals, exact, rest, alone = [], {}, [], []
+        for i, f in group:
+            if f.glob and not set(GLOB_META).intersection(f.pattern):
+                exact.setdefault(f.pattern, []).append(i)
+            elif not f.glob and f.pattern and \
+                    not REGEX_META.intersection(f.pattern):
+                literals.append((f.pattern, i))
+            elif f._regex.groups:
+                # joined with others, the groups would be renumbered and
+                # backreferences would point to the wrong group.
+                alone.append((i, f))
+            else:
+                rest.append((i, f))
+
+        automaton = AhoCorasick(literals) if literals else None
+        prefilter = None
+        if len(rest) > 1:
+            try:
+                prefilter = re.compile('|'.join(
+                        ('^' if f.glob else '') + f'(?:{f._regex.pattern})'
+                        for i, f in rest))
+            except re.error:
+                # e.g. clashing group names, try each pattern instead.
+                prefilter = None
+        return automaton, exact, rest, prefilter, alone
+
+    def routes(self, text):
+        """
+            the sorted indices of the filters matching `text`.
+        """
+        last, found = self._last
+        if text == last:
+            return found
+
+        name = text.rstrip('/').split('/')[-1]
+        found = set()
+        for basename, automaton, exact, rest, prefilter, alone in \
+                self._plans:
+            target = name if basename else text
+            if automaton:
+                found.update(automaton.search(target))
+            found.update(exact.get(target, ()))
+            if rest and (prefilter is None or prefilter.search(target)):
+                found.update(i for i, f in rest
+                             if f._match(target) is not None)
+            found.update(i for i, f in alone 
+                         if f._match(target) is not None)
+
+        found = sorted(found)
+        self._last = (text, found)
+        return found
+
+    def match(self, rel):
+        return bool(self.routes(rel))
+
+    __call__ = match
+
+    def can_descend(self, rel):
+        return any(f.can_descend(rel) for f in self.filters)
@@ -0,0 +1,204 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import re
+import bz2
+import csv
+import gzip
+import json
+import sqlite3
+
+# rows inserted into the local evaluator per transaction.
+BATCH_SIZE = 10000
+
+COMPRESSION_SUFFIXES = {'.gz':'GZIP', '.gzip':'GZIP', '.bz2':'BZIP2'}
+JSON_SUFFIXES = ('.json', '.jsonl', '.ndjson')
+MAGIC = {b'\x1f\x8b':'GZIP', b'BZh':'BZIP2'}
+
+# `S3Object[*].path` addresses json documents in s3 select, the local
+# evaluator flattens the top level keys into columns instead.
+_JSON_PATH = re.compile(r'S3Object\[\*\](\.\w+)*', re.IGNORECASE)
+
+def guess_compression(key):
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if key.lower().endswith(suffix):
+            return compression
+    return 'NONE'
+
+def guess_format(key):
+    name = key.lower()
+    for suffix in COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return 'json' if name.endswith(JSON_SUFFIXES) else 'csv'
+
+def s3_select(client, bucket_name, key, expression, fp, input_format='csv',
+              compression='NONE', header=True, delimiter=',',
+              output_format='csv'):
+    """
+        run an s3 select `expression` on an object, writing the matching
+        records to the binary stream `fp` as they arrive. Returns the
+        scan statistics.
+    """
+    serialization = {'CompressionType':compression}
+    if input_format == 'json':
+        serialization['JSON'] = {'Type':'LINES'}
+    else:
+        serialization['CSV'] = {
+                'FileHeaderInfo':'USE' if header else 'NONE',
+                'FieldDelimiter':delimiter}
+    if output_format == 'json':
+        output = {'JSON':{'RecordDelimiter':'\n'}}
+    else:
+        output = {'CSV':{}}
+
+    response = client.select_object_content(
+            Bucket=bucket_name, Key=key, Expression=expression,
+            ExpressionType='SQL', InputSerialization=serialization,
+            OutputSerialization=output)
+
+    stats = {}
+    for event in response['Payload']:
+        if 'Records' in event:
+            fp.write(event['Records']['Payload'])
+        elif 'Stats' in event:
+            stats = event['Stats']['Details']
+    return stats
+
+class LocalSelect(object):
+    '''
+        An in-process stand-in for s3 select. The object is streamed
+        through the (decompressed) input parser into a temporary on-disk
+        sqlite table named `S3Object`, in batches, and the expression is
+        run against it. CSV values are kept as text like in s3 select,
+        so numeric comparisons need a CAST. JSON lines are flattened to
+        their top level keys, nested values are stored as json text.
+    '''
+
+    def __init__(self, stream, size=None):
+        self._stream = stream
+        self._size = size
+        self._conn = sqlite3.connect('')
+        self._columns = []
+
+    def run(self, expression, fp, input_format='csv', compression='NONE',
+            header=True, delimiter=',', output_format='csv'):
+        self._load(self._text(compression), input_format, header, delimiter)
+        cursor = self._conn.execute(_JSON_PATH.sub('S3Object', expression))
+        names = [d[0] for d in cursor.description]
+
+        counter = ByteCounter(fp)
+        out = io.TextIOWrapper(counter, encoding='utf-8', newline='',
+                               write_through=True)
+        writer = csv.writer(out, lineterminator='\n')
+        for rows in iter(lambda:cursor.fetchmany(BATCH_SIZE), []):
+            if output_format == 'json':
+                out.write(''.join(json.dumps(dict(zip(names, row)))+'\n'
+                                  for row in rows))
+            else:
+                writer.writerows(rows)
+        out.flush()
+        out.detach()
+        self._conn.close()
+
+        return {'BytesScanned':self._size, 'BytesProcessed':self._size,
+                'BytesReturned':counter.written}
+
+    def _text(self, compression):
+        stream = self._stream
+        if compression == 'NONE' and hasattr(stream, 'peek'):
+            compression = MAGIC.get(stream.peek(3)[:3]) or MAGIC.get(
+                    stream.peek(2)[:2]) or 'NONE'
+        if compression == 'GZIP':
+            stream = gzip.GzipFile(fileobj=stream)
+        elif compression == 'BZIP2':
+            stream = bz2.BZ2File(stream)
+        return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    def _load(self, text, input_format, header, delimiter):
+        if input_format == 'json':
+            rows = (json.loads(line) for line in text if line.strip())
+        else:
+            reader = csv.reader(text, delimiter=delimiter)
+            names = next(reader, []) if header else None
+            rows = (self._csv_row(row, names) for row in reader)
+            if names:
+                self._add_columns(names)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+        if not self._columns:
+            # an empty object is an empty table.
+            self._add_columns(['_1'])
+
+    @classmethod
+    def _csv_row(cls, row, names):
+        if names is None:
+            return {f'_{i+1}':v for i, v in enumerate(row)}
+        return dict(zip(names, row))
+
+    def _add_columns(self, names):
+        names = [n for n in dict.fromkeys(names) if n not in self._columns]
+        if not names:
+            return
+        if not self._columns:
+            columns = ','.join(_quote(n) for n in names)
+            self._conn.execute(f'CREATE TABLE S3Object ({columns})')
+        else:
+            for name in names:
+                self._conn.execute(
+                        f'ALTER TABLE S3Object ADD COLUMN {_quote(name)}')
+        self._columns.extend(names)
+
+    def _insert(self, batch):
+        if not batch:
+            return
+        self._add_columns([name for row in batch for name in row])
+
+        marks = ','.join('?'*len(self._columns))
+        columns = ','.join(_quote(c) for c in self._columns)
+        self._conn.executemany(
+                f'INSERT INTO S3Object ({columns}) VALUES ({marks})',
+                [[_value(row.get(c)) for c in self._columns]
+                 for row in batch])
+        self._conn.commit()
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+class ByteCounter(io.RawIOBase):
+    # counts the bytes written through to a binary stream.
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._fp.write(b)
+        self.written += len(b)
+        return len(b)
@@ -12,21 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import os
+import bz2
+import gzip
+import mmap
 import logging
-import boto3
-from botocore.exceptions import ClientError
+import heapq
+import queue
+import shutil
+import string
+import sys
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import (ClientError, EventStreamError, 
+                                 BotoCoreError)
 
+from piggin.common.auth import get_session, get_client, get_resource
 from piggin.common.utils import confirm_action
+from piggin.s3.cache import ListingCache
+from piggin.s3.filters import KeyFilter
+from piggin.s3.sync import Md5Cache, local_entries, s3_entries, diff
+from piggin.s3.stream import S3Reader, S3Writer, get_range
+from piggin.s3.query import (LocalSelect, ByteCounter, s3_select, 
+                             guess_format, guess_compression)
+from piggin.s3.transfer import (TransferScheduler, Progress, FileSlice, 
+                                DownloadState, 
+                                part_size_for, split_ranges, run_parallel, 
+                                write_at, DEFAULT_PART_SIZE, 
+                                DEFAULT_CONCURRENCY)
+
+# chunk size for streaming a response body to disk.
+CHUNK_SIZE = 1024*1024
+
+# source or destination path standing for stdin or stdout.
+STDIO = '-'
+
+# S3 returns (and deletes) at most 1000 keys per call.
+MAX_PAGE_SIZE = 1000
+
+# split points for sharding a flat keyspace by character ranges, must 
+# be in sorted (utf-8 byte) order.
+SHARD_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
 
 class AwsS3(object):
     
-    def __init__(self, access_key=None, secret_key=None, profile_name=None):
-        session = boto3.Session(aws_access_key_id=access_key,
-                                aws_secret_access_key=secret_key,
-                                profile_name=profile_name)
+    def __init__(self, access_key=None, secret_key=None, profile_name=None,
+                 max_pool_connections=None, cache=None, metrics=None):
+        # sessions, clients and their connection pools are shared across
+        # instances, see `piggin.common.auth`.
+        self._credentials = (access_key, secret_key, profile_name)
+        session = get_session(access_key, secret_key, profile_name)
         self._default_region = session.region_name
-        self._s3r = session.resource('s3')
-        self._s3c = session.client('s3')
+        self._s3r = get_resource(
+                's3', access_key, secret_key, profile_name,
+                max_pool_connections=max_pool_connections)
+        self._s3c = get_client(
+                's3', access_key, secret_key, profile_name,
+                max_pool_connections=max_pool_connections)
+        
+        # optional on-disk listing cache, see `piggin.s3.cache`.
+        if cache is True:
+            cache = ListingCache()
+        self._cache = cache or None
+        if self._cache:
+            self._cache.register(self._s3c)
+            self._cache.register(self._s3r.meta.client)
+        
+        # optional instrumentation, see `piggin.common.metrics`.
+        self._metrics = metrics
+        if metrics:
+            metrics.register(self._s3c)
+            metrics.register(self._s3r.meta.client)
         self._logger = logging.getLogger('s3')
         
     def mkdir(self, str_path, confirm, parent, location, acl):
@@ -75,7 +133,7 @@ class AwsS3(object):
                 parent_key = '/'.join(all_keys[:-1])
                 if not parent_key.endswith('/'):
                     parent_key = parent_key+'/'
-                objects = self.list_objects(bucket, parent_key)
+                objects = self.list_objects(bucket, parent_key, max_keys=1)
                 if not objects:
                     msg = f'cannot create, parent {parent_key} does not exist.'
                     self._logger.error(msg)
@@ -95,18 +153,320 @@ class AwsS3(object):
                 key = key+'/'
             self.touch(bucket, key)
     
-    def copy(self, str_src, str_dest):
+    def copy(self, str_src, str_dest, part_size=None, concurrency=None,
+             resume=True):
+        protocol1, bucket1, key1, path1 = self.parse_path(str_src)
+        protocol2, bucket2, key2, path2 = self.parse_path(str_dest)
+        
+        if str_src == STDIO and protocol2 == 's3':
+            self.upload_stream(bucket2, key2, sys.stdin.buffer, 
+                               part_size=part_size, concurrency=concurrency)
+        elif protocol1 == 's3' and str_dest == STDIO:
+            self.download_stream(bucket1, key1, sys.stdout.buffer, 
+                                 part_size=part_size, 
+                                 concurrency=concurrency)
+        elif protocol1 == 's3' and protocol2 == 'file':
+            self.download(bucket1, key1, path2, part_size=part_size,
+                          concurrency=concurrency, resume=resume)
+        elif protocol1 == 'file' and protocol2 == 's3':
+            self.upload(bucket2,key2,path1, part_size=part_size, 
+                        concurrency=concurrency)
+        elif protocol1 == 's3' and protocol2 == 's3':
+            self.copy_object(bucket1, key1, bucket2, key2, 
+                             part_size=part_size, concurrency=concurrency)
+        else:
+            msg = 'Unknown source {} or destination {}'.format(
+                    str_src, str_dest)
+            raise ValueError(msg)
+            
+    def cp(self, str_src, str_dest, recursive=False, pattern=None, 
+           glob=False, workers=8, part_size=None, concurrency=None, 
+           resume=True, verbose=False, move=False, use_async=False):
+        """
+            Copy files or keys between local fs and s3, or between two s3 
+            locations (server-side), in either direction. If `recursive` 
+            is True, all files under the source directory or prefix are 
+            copied, preserving the relative paths, optionally filtered by 
+            `pattern` (a regex, or a glob if `glob` is True) matched 
+            against the relative path, see `piggin.s3.filters`. The 
+            listing skips the prefixes the pattern rules out. All copies 
+            run on a single pool of `workers` threads. If `move` is True,
+            the sources are deleted after a successful copy. If 
+            `use_async` is True, the copies run on the asyncio backend 
+            (see `piggin.s3.aio`) with up to `workers` requests in flight
+            instead, except for those above the part size, which take 
+            the threaded multipart path. A source or destination of '-'
+            streams from stdin or to stdout. Returns a tuple of number of
+            files copied and list of failures.
+        """
+        key_filter = self._compile_pattern(pattern, glob)
+        piped = STDIO in (str_src, str_dest)
+        if piped and recursive:
+            raise ValueError('cannot copy recursively to or from a pipe.')
+        
+        def transfer(src, dest):
+            self._copy(src, dest, part_size=part_size, 
+                       concurrency=concurrency, resume=resume)
+            if move and src != STDIO:
+                self._remove(src)
+            if verbose:
+                action = 'moved' if move else 'copied'
+                out = sys.stderr if dest == STDIO else sys.stdout
+                print(f'{action} {src} to {dest}.', file=out)
+        
+        if use_async and not piped:
+            from piggin.s3.aio import run_transfers
+            pairs = ((src, dest) for src, dest, rel in self._transfer_pairs(
+                    str_src, str_dest, recursive, workers=1, 
+                    key_filter=key_filter))
+            # objects over a part go through the threaded multipart path.
+            return run_transfers(
+                    pairs, *self._credentials, max_inflight=workers, 
+                    move=move, verbose=verbose, fallback=transfer,
+                    max_size=part_size or DEFAULT_PART_SIZE)
+        
+        def tasks():
+            if piped:
+                yield transfer, str_src, str_dest
+                return
+            for src, dest, rel in self._transfer_pairs(
+                    str_src, str_dest, recursive, workers, key_filter):
+                yield transfer, src, dest
+        
+        scheduler = TransferScheduler(workers=workers)
+        failures = scheduler.run(tasks())
+        return scheduler.done, failures
+    
+    def mv(self, str_src, str_dest, recursive=False, pattern=None, 
+           glob=False, workers=8, part_size=None, concurrency=None, 
+           resume=True, verbose=False, use_async=False):
+        return self.cp(str_src, str_dest, recursive=recursive, 
+                       pattern=pattern, glob=glob, workers=workers, 
+                       part_size=part_size, concurrency=concurrency, 
+                       resume=resume, verbose=verbose, move=True,
+                       use_async=use_async)
+        
+    def sync(self, str_src, str_dest, delete=False, checksum=False, 
+             dry_run=False, pattern=None, glob=False, workers=8, 
+             part_size=None, concurrency=None, verbose=False):
+        """
+            Incrementally copy a directory or prefix to another. Both 
+            sides are listed as sorted streams and merge-joined, and only 
+            files which are missing or differ at the destination are 
+            copied. Files differ if the sizes differ, or if the source is 
+            newer (or, if `checksum` is True, if the s3 etag and the 
+            cached local md5 differ). If `delete` is True, files at the 
+            destination with no source are deleted. If `dry_run` is True, 
+            the actions are only printed. Returns a tuple of number of 
+            actions completed and list of failures.
+        """
+        part_size = part_size or DEFAULT_PART_SIZE
+        key_filter = self._compile_pattern(pattern, glob)
+        md5cache = Md5Cache() if checksum else None
+        
+        src_root, src = self._sync_entries(str_src, workers)
+        if not src_root.startswith('s3:') and not os.path.isdir(src_root):
+            raise ValueError(f'source {str_src} is not a directory.')
+        dest_root, dest = self._sync_entries(str_dest, workers)
+        if not src_root.startswith('s3:') and \
+                not dest_root.startswith('s3:'):
+            msg = 'Unknown source {} or destination {}'.format(
+                    str_src, str_dest)
+            raise ValueError(msg)
+        
+        if key_filter:
+            src = (e for e in src if key_filter(e.rel))
+            dest = (e for e in dest if key_filter(e.rel))
+            
+        def etag(entry, root, part_size):
+            if entry.etag is not None:
+                return entry.etag
+            return md5cache.etag(self._join_path(root, entry.rel), part_size)
+        
+        def compare(s, d):
+            if s.size != d.size:
+                return False
+            if not checksum:
+                # s3 timestamps are upload times (in whole seconds), so
+                # only a newer source is taken as a change.
+                return int(s.mtime) <= int(d.mtime)
+            etags = [e.etag for e in (s, d) if e.etag is not None]
+            multipart = part_size if any('-' in e for e in etags) else None
+            return etag(s, src_root, multipart) == etag(
+                    d, dest_root, multipart)
+            
+        def copy(s, src_path, dest_path):
+            self._copy(src_path, dest_path, part_size=part_size, 
+                       concurrency=concurrency, resume=True)
+            if not dest_path.startswith('s3:'):
+                os.utime(dest_path, (s.mtime, s.mtime))
+            if verbose:
+                print(f'copied {src_path} to {dest_path}.')
+                
+        def remove(dest_path):
+            self._remove(dest_path)
+            if verbose:
+                print(f'deleted {dest_path}.')
+        
+        def tasks():
+            for action, s, d in diff(src, dest, compare):
+                if action == 'copy':
+                    src_path = self._join_path(src_root, s.rel)
+                    dest_path = self._join_path(dest_root, s.rel)
+                    if dry_run:
+                        print(f'(dryrun) copy {src_path} to {dest_path}.')
+                        continue
+                    yield copy, s, src_path, dest_path
+                elif delete:
+                    dest_path = self._join_path(dest_root, d.rel)
+                    if dry_run:
+                        print(f'(dryrun) delete {dest_path}.')
+                        continue
+                    yield remove, dest_path
+        
+        scheduler = TransferScheduler(workers=workers)
+        try:
+            failures = scheduler.run(tasks())
+        finally:
+            if md5cache:
+                md5cache.save()
+        return scheduler.done, failures
+    
+    def _sync_entries(self, str_path, workers=1):
+        protocol, bucket, key, path = self.parse_path(str_path)
+        if protocol == 'file':
+            return path, local_entries(path)
+        
+        if key and not key.endswith('/'):
+            key = key + '/'
+        # the diff decides what to copy and delete, never from a stale 
+        # cached listing.
+        contents = self._list_s3_contents(
+                bucket, key, workers=workers, cached=False)
+        return 's3:///' + bucket + '/' + key, s3_entries(contents, key)
+    
+    @classmethod
+    def _join_path(cls, root, rel):
+        if root.startswith('s3:'):
+            return root + rel
+        return os.path.join(root, *rel.split('/'))
+        
+    def _copy(self, str_src, str_dest, part_size=None, concurrency=None,
+              resume=True):
+        part_size = part_size or DEFAULT_PART_SIZE
+        concurrency = concurrency or DEFAULT_CONCURRENCY
         protocol1, bucket1, key1, path1 = self.parse_path(str_src)
         protocol2, bucket2, key2, path2 = self.parse_path(str_dest)
         
-        if protocol1 == 's3' and protocol2 == 'file':
-            self.download(bucket1, key1, path2)
+        if str_src == STDIO and protocol2 == 's3':
+            self._upload_stream(
+                    bucket2, key2, sys.stdin.buffer, part_size, concurrency)
+        elif protocol1 == 's3' and str_dest == STDIO:
+            self._download_stream(
+                    bucket1, key1, sys.stdout.buffer, part_size, concurrency)
+        elif protocol1 == 's3' and protocol2 == 'file':
+            dirname = os.path.dirname(path2)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._ranged_download(
+                    bucket1, key1, path2, part_size, concurrency, resume)
         elif protocol1 == 'file' and protocol2 == 's3':
-            self.upload(bucket2,key2,path1)
+            self._upload(bucket2, key2, path1, part_size, concurrency)
+        elif protocol1 == 's3' and protocol2 == 's3':
+            self._copy_object(
+                    bucket1, key1, bucket2, key2, part_size, concurrency)
         else:
-            raise('Unknown source {} or destination {}'.format(str_src, str_dest))
+            msg = 'Unknown source {} or destination {}'.format(
+                    str_src, str_dest)
+            raise ValueError(msg)
+            
+    def _remove(self, str_path):
+        protocol, bucket, key, path = self.parse_path(str_path)
+        if protocol == 's3':
+            self._s3c.delete_object(Bucket=bucket, Key=key)
+        else:
+            os.remove(path)
+            
+    def _transfer_pairs(self, str_src, str_dest, recursive, workers=1,
+                        key_filter=None):
+        """
+            Generate (source, destination, relative path) for a copy from 
+            `str_src` to `str_dest`, for the relative paths matching the 
+            `key_filter` if given.
+        """
+        protocol1, bucket1, key1, path1 = self.parse_path(str_src)
+        protocol2, bucket2, key2, path2 = self.parse_path(str_dest)
+        
+        if protocol1 == 'file' and protocol2 == 'file':
+            msg = 'Unknown source {} or destination {}'.format(
+                    str_src, str_dest)
+            raise ValueError(msg)
+        
+        def target(rel, is_dir):
+            if protocol2 == 's3':
+                prefix = key2
+                if is_dir and prefix and not prefix.endswith('/'):
+                    prefix = prefix + '/'
+                elif not is_dir and prefix and not prefix.endswith('/'):
+                    return 's3:///' + bucket2 + '/' + prefix
+                return 's3:///' + bucket2 + '/' + prefix + rel
+            else:
+                if is_dir or path2.endswith(('/', os.sep)) or \
+                        os.path.isdir(path2):
+                    return os.path.join(path2, *rel.split('/'))
+                return path2
+        
+        if protocol1 == 'file':
+            if os.path.isdir(path1):
+                if not recursive:
+                    msg = f'{path1} is a directory, use recursive copy.'
+                    raise ValueError(msg)
+                for root, dirs, files in os.walk(path1):
+                    base = os.path.relpath(root, path1).replace(os.sep, '/')
+                    base = '' if base == '.' else base + '/'
+                    dirs[:] = sorted(d for d in dirs if not key_filter or 
+                                     key_filter.can_descend(base + d + '/'))
+                    for name in sorted(files):
+                        rel = base + name
+                        if key_filter and not key_filter(rel):
+                            continue
+                        yield os.path.join(root, name), target(rel, True), rel
+            else:
+                rel = os.path.basename(path1)
+                if not key_filter or key_filter(rel):
+                    yield path1, target(rel, False), rel
+            return
+        
+        if not recursive:
+            rel = key1.split('/')[-1]
+            if not key_filter or key_filter(rel):
+                yield 's3:///' + bucket1 + '/' + key1, target(rel, False), rel
+            return
+        
+        prefix = key1
+        if prefix and not prefix.endswith('/'):
+            prefix = prefix + '/'
+        if key_filter:
+            keys = self.iter_matching(bucket1, prefix, key_filter, 
+                                      recursive=True, workers=workers)
+        else:
+            keys = self.ls('s3:///' + bucket1 + '/' + prefix, 
+                           recursive=True, workers=workers)
+        for key in keys:
+            if key.endswith('/'):
+                continue
+            rel = key[len(prefix):]
+            yield 's3:///' + bucket1 + '/' + key, target(rel, True), rel
+            
+    @classmethod
+    def _compile_pattern(cls, pattern, glob=False):
+        if not pattern:
+            return None
+        return KeyFilter(pattern, glob=glob)
     
-    def rm(self, str_path, confirm=True, recursive=False):
+    def rm(self, str_path, confirm=True, recursive=False, workers=8, 
+           dry_run=False, verbose=True, versions=False, pattern=None,
+           glob=False):
         if not str_path.startswith('s3:'):
             str_path = 's3:///' + str_path
             
@@ -124,7 +484,11 @@ class AwsS3(object):
             tmp_key = key
             if key != '' and not key.endswith('/'):
                 tmp_key = key+'/'
-            objects = self.list_objects(bucket, tmp_key)
+            # the emptiness check must see writes by other clients.
+            objects = self.list_objects(
+                    bucket, tmp_key, max_keys=2, cached=False)
+            if objects is None:
+                return
             if tmp_key in objects:
                 objects.remove(tmp_key)
             if objects:
@@ -132,29 +496,57 @@ class AwsS3(object):
                 self._logger.error(msg)
                 return
         
-        if key == '':
+        if dry_run:
+            confirm = False
+        
+        if key == '' and not pattern:
             if confirm:
                 msg = f'are you sure to delete bucket {bucket}'
                 response = confirm_action(msg)
                 if not response:
                     return
-            self.delete_bucket(bucket)
+            return self.delete_bucket(
+                    bucket, workers=workers, dry_run=dry_run, 
+                    verbose=verbose)
         else:
             if confirm:
-                msg = f'are you sure to delete {key} in {bucket}'
+                target = f'{pattern} under {key or "/"}' if pattern else key
+                msg = f'are you sure to delete {target} in {bucket}'
                 response = confirm_action(msg)
                 if not response:
                     return
-            self.delete_objects(bucket, key)
+            if versions:
+                return self.purge_versions(
+                        bucket, key, workers=workers, dry_run=dry_run,
+                        verbose=verbose)
+            return self.delete_objects(
+                    bucket, key, workers=workers, dry_run=dry_run, 
+                    verbose=verbose, 
+                    key_filter=self._compile_pattern(pattern, glob))
     
-    def ls(self, str_path):
+    def ls(self, str_path, page_size=None, max_keys=None, recursive=False,
+           workers=1, pattern=None, glob=False):
         if not str_path.startswith('s3:'):
             str_path = 's3:///' + str_path
         
         protocol, bucket, key, path = self.parse_path(str_path)
         if protocol == 's3':
-            if bucket:
-                return self.list_objects(bucket, key)
+            if bucket and pattern:
+                if key and not key.endswith('/'):
+                    key = key + '/'
+                keys = self.iter_matching(
+                        bucket, key, self._compile_pattern(pattern, glob),
+                        recursive=recursive, workers=workers, 
+                        page_size=page_size)
+                return itertools.islice(keys, max_keys)
+            elif bucket and recursive and workers and workers > 1:
+                return self.iter_objects_sharded(
+                        bucket, key, workers=workers, page_size=page_size, 
+                        max_keys=max_keys)
+            elif bucket:
+                return self.iter_objects(
+                        bucket, key, page_size=page_size, max_keys=max_keys,
+                        recursive=recursive)
             else:
                 return self.ls_bucket()
         else:
@@ -169,25 +561,236 @@ class AwsS3(object):
             msg = f'listing buckets:'+str(e)
             self._logger.error(msg)
             
-    def list_objects(self, bucket, key):     
+    def list_objects(self, bucket, key, page_size=None, max_keys=None,
+                     cached=True):
         if bucket == '' or bucket is None:
             self._logger.error('missing bucket name.')
             return
         
         try:
-            objects = self._list_s3_objects(bucket, key)
+            objects = self._list_s3_objects(
+                    bucket, key, page_size=page_size, max_keys=max_keys,
+                    cached=cached)
             return [o for o in objects]
         except Exception as e:
             msg = f'listing {key} in {bucket}:'+str(e)
             self._logger.error(msg)
+            
+    def iter_objects(self, bucket, key, page_size=None, max_keys=None, 
+                     recursive=False):
+        """
+            Lazily list keys and common prefixes under `key`, one page at 
+            a time. Unlike `list_objects` this never materializes the full 
+            listing, so memory stays flat irrespective of the prefix size.
+            If `recursive` is True, all keys under `key` are listed without 
+            grouping them by common prefixes.
+        """
+        if bucket == '' or bucket is None:
+            self._logger.error('missing bucket name.')
+            return
+        
+        delimiter = None if recursive else '/'
+        try:
+            for obj in self._list_s3_objects(
+                    bucket, key, delimiter=delimiter, page_size=page_size, 
+                    max_keys=max_keys):
+                yield obj
+        except Exception as e:
+            msg = f'listing {key} in {bucket}:'+str(e)
+            self._logger.error(msg)
+            
+    def iter_objects_sharded(self, bucket, key, workers=8, page_size=None,
+                             max_keys=None):
+        """
+            Recursively list all keys under `key`, splitting the keyspace 
+            into shards that are listed concurrently on a pool of `workers`
+            threads. The results are merged back into a single stream in 
+            the same (lexicographic) order as a sequential listing.
+        """
+        if bucket == '' or bucket is None:
+            self._logger.error('missing bucket name.')
+            return
+        
+        try:
+            objects = self._list_s3_sharded(
+                    bucket, key, workers=workers, page_size=page_size)
+            for obj in itertools.islice(objects, max_keys):
+                yield obj.get('Key')
+        except Exception as e:
+            msg = f'listing {key} in {bucket}:'+str(e)
+            self._logger.error(msg)
     
-    def upload(self, bucket_name, key, file_name):
+    def iter_matching(self, bucket, key, key_filter, recursive=True, 
+                      workers=1, page_size=None):
+        """
+            Lazily list the keys (and common prefixes if not `recursive`) 
+            under `key` with paths relative to `key` matching the 
+            `key_filter`, see `piggin.s3.filters`. The literal prefix of 
+            the pattern is pushed into the listing prefix, and patterns 
+            constraining directories are listed by walking the prefix 
+            tree, with up to `workers` prefixes listed at a time, and 
+            skipping the subtrees that cannot match.
+        """
+        if bucket == '' or bucket is None:
+            self._logger.error('missing bucket name.')
+            return
+        
+        try:
+            for k in self._list_s3_matching(
+                    bucket, key, key_filter, recursive, workers, page_size):
+                yield k
+        except Exception as e:
+            msg = f'listing {key} in {bucket}:'+str(e)
+            self._logger.error(msg)
+    
+    def upload(self, bucket_name, key, file_name, part_size=None, 
+               concurrency=None):
+        """
+            Upload a local file. Files larger than `part_size` are sent 
+            as a multipart upload, with up to `concurrency` parts in 
+            flight at a time.
+        """
+        part_size = part_size or DEFAULT_PART_SIZE
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        
+        try:
+            self._upload(bucket_name, key, file_name, part_size, concurrency)
+        except Exception as e:
+            self._logger.error(str(e))
+            
+    def _upload(self, bucket_name, key, file_name, part_size, concurrency):
+        size = os.path.getsize(file_name)
+        if size > part_size:
+            self._multipart_upload(
+                    bucket_name, key, file_name, size, part_size, 
+                    concurrency)
+            return
+        
         with open(file_name, 'rb') as fd:
-            try:
-                self._s3r.Object(bucket_name, key).put(Body=fd)
-            except Exception as e:
-                self._logger.error(str(e))
+            self._s3c.put_object(Bucket=bucket_name, Key=key, Body=fd)
                 
+    def upload_stream(self, bucket_name, key, fp, part_size=None,
+                      concurrency=None):
+        """
+            Upload the content of a binary stream (e.g. stdin) of unknown
+            length. The data is sent as multipart upload parts as it is 
+            read, see `open`, and never staged on disk.
+        """
+        try:
+            self._upload_stream(bucket_name, key, fp, part_size, concurrency)
+        except Exception as e:
+            self._logger.error(str(e))
+            
+    def _upload_stream(self, bucket_name, key, fp, part_size, concurrency):
+        with self.open(bucket_name, key, 'wb', part_size=part_size,
+                       concurrency=concurrency) as out:
+            shutil.copyfileobj(fp, out, CHUNK_SIZE)
+    
+    def _multipart_upload(self, bucket_name, key, file_name, size, 
+                          part_size, concurrency):
+        part_size = part_size_for(size, part_size)
+        ranges = split_ranges(size, part_size)
+        
+        response = self._s3c.create_multipart_upload(
+                Bucket=bucket_name, Key=key)
+        upload_id = response['UploadId']
+        
+        def upload_part(mm, part_number, start, end):
+            with FileSlice(mm, start, end) as body:
+                response = self._s3c.upload_part(
+                        Bucket=bucket_name, Key=key, UploadId=upload_id, 
+                        PartNumber=part_number, Body=body)
+            return {'PartNumber':part_number, 'ETag':response['ETag']}
+        
+        try:
+            with open(file_name, 'rb') as fd:
+                mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    parts = run_parallel(
+                            upload_part, [(mm, i+1, start, end) for i, (
+                                    start, end) in enumerate(ranges)], 
+                            concurrency)
+                finally:
+                    try:
+                        mm.close()
+                    except BufferError:
+                        # views read from the parts are still held by
+                        # the traceback of a failed upload, the map is
+                        # unmapped once they are collected.
+                        pass
+            
+            self._s3c.complete_multipart_upload(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts':parts})
+        except BaseException:
+            self._abort_multipart_upload(bucket_name, key, upload_id)
+            raise
+            
+    def copy_object(self, src_bucket, src_key, bucket_name, key, 
+                    part_size=None, concurrency=None):
+        """
+            Server-side copy of an s3 object. Objects larger than 
+            `part_size` are copied with concurrent `UploadPartCopy` calls,
+            the data never leaves s3.
+        """
+        part_size = part_size or DEFAULT_PART_SIZE
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        
+        try:
+            self._copy_object(src_bucket, src_key, bucket_name, key, 
+                              part_size, concurrency)
+        except Exception as e:
+            msg = f'copying {src_key} in {src_bucket}:'+str(e)
+            self._logger.error(msg)
+            
+    def _copy_object(self, src_bucket, src_key, bucket_name, key, part_size,
+                     concurrency):
+        source = {'Bucket':src_bucket, 'Key':src_key}
+        head = self._s3c.head_object(Bucket=src_bucket, Key=src_key)
+        size = head['ContentLength']
+        
+        if size <= part_size:
+            self._s3c.copy_object(
+                    Bucket=bucket_name, Key=key, CopySource=source)
+            return
+        
+        part_size = part_size_for(size, part_size)
+        ranges = split_ranges(size, part_size)
+        kwargs = {'Bucket':bucket_name, 'Key':key, 
+                  'Metadata':head.get('Metadata', {})}
+        if head.get('ContentType'):
+            kwargs['ContentType'] = head['ContentType']
+        response = self._s3c.create_multipart_upload(**kwargs)
+        upload_id = response['UploadId']
+        
+        def copy_part(part_number, start, end):
+            response = self._s3c.upload_part_copy(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=part_number, CopySource=source,
+                    CopySourceRange=f'bytes={start}-{end-1}',
+                    CopySourceIfMatch=head['ETag'])
+            etag = response['CopyPartResult']['ETag']
+            return {'PartNumber':part_number, 'ETag':etag}
+        
+        try:
+            parts = run_parallel(
+                    copy_part, [(i+1, start, end) for i, (
+                            start, end) in enumerate(ranges)], concurrency)
+            self._s3c.complete_multipart_upload(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts':parts})
+        except BaseException:
+            self._abort_multipart_upload(bucket_name, key, upload_id)
+            raise
+            
+    def _abort_multipart_upload(self, bucket_name, key, upload_id):
+        try:
+            self._s3c.abort_multipart_upload(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id)
+        except Exception as e:
+            msg = f'aborting upload {upload_id} for {key} in {bucket_name}:'
+            self._logger.error(msg+str(e))
+    
     def touch(self, bucket_name, key):
         if bucket_name == '' or bucket_name is None:
             self._logger.error('missing bucket name.')
@@ -202,11 +805,211 @@ class AwsS3(object):
         except Exception as e:
             self._logger.error(str(e))
     
-    def download(self, bucket_name, key, file_name):
+    def download(self, bucket_name, key, file_name, part_size=None,
+                 concurrency=None, resume=True):
+        """
+            Download an object to a local file. Objects larger than 
+            `part_size` are fetched as concurrent ranged GETs written 
+            directly into a preallocated file. Progress is recorded in a 
+            sidecar state file, so that if `resume` is True an interrupted 
+            download continues from the last finished range.
+        """
+        part_size = part_size or DEFAULT_PART_SIZE
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        
         try:
-            self._s3r.Bucket(bucket_name).download_file(key, file_name)
+            self._ranged_download(
+                    bucket_name, key, file_name, part_size, concurrency, 
+                    resume)
         except Exception as e:
             self._logger.error(str(e))
+            
+    def download_stream(self, bucket_name, key, fp, part_size=None,
+                        concurrency=None):
+        """
+            Write an object to a binary stream (e.g. stdout), fetched as 
+            sequential ranged GETs with read-ahead, see `open`.
+        """
+        try:
+            self._download_stream(
+                    bucket_name, key, fp, part_size, concurrency)
+        except Exception as e:
+            self._logger.error(str(e))
+            
+    def _download_stream(self, bucket_name, key, fp, part_size, 
+                         concurrency):
+        with self.open(bucket_name, key, 'rb', part_size=part_size,
+                       concurrency=concurrency) as src:
+            shutil.copyfileobj(src, fp, CHUNK_SIZE)
+        fp.flush()
+            
+    def cat(self, bucket_name, key, fp=None, decompress=False):
+        """
+            Write an object to a binary stream (stdout by default), 
+            decompressing gzip or bzip2 objects if `decompress` is True.
+            Returns True on success.
+        """
+        fp = fp or sys.stdout.buffer
+        try:
+            if not decompress:
+                self._download_stream(bucket_name, key, fp, None, None)
+                return True
+            with self.open(bucket_name, key, 'rb') as src:
+                compression = guess_compression(key)
+                if compression == 'GZIP':
+                    src = gzip.GzipFile(fileobj=src)
+                elif compression == 'BZIP2':
+                    src = bz2.BZ2File(src)
+                shutil.copyfileobj(src, fp, CHUNK_SIZE)
+            fp.flush()
+            return True
+        except Exception as e:
+            self._logger.error(str(e))
+            
+    def query(self, bucket_name, key, expression, fp=None, 
+              input_format=None, compression=None, header=True, 
+              delimiter=',', output_format=None, engine='auto'):
+        """
+            Run an s3 select SQL `expression`, e.g. `SELECT s.name FROM 
+            S3Object s WHERE CAST(s.age AS INT) > 30`, against a CSV or 
+            JSON lines object, and write the matching records to a binary 
+            stream (stdout by default) as csv or json lines. Only the 
+            matching records leave s3. The input format and compression 
+            are guessed from the key unless given, the output format 
+            defaults to the input format. With `engine` 'auto', the query 
+            is evaluated locally on a streamed read of the object if s3 
+            select is not available, 'local' always does, and 's3' never 
+            does. Returns the scan statistics, or None on failure.
+        """
+        fp = fp or sys.stdout.buffer
+        input_format = input_format or guess_format(key)
+        kwargs = {'input_format':input_format, 
+                  'compression':compression or guess_compression(key),
+                  'header':header, 'delimiter':delimiter, 
+                  'output_format':output_format or input_format}
+        
+        try:
+            stats = self._query(
+                    bucket_name, key, expression, fp, engine, kwargs)
+            fp.flush()
+            return stats
+        except Exception as e:
+            self._logger.error(f'querying {key} in {bucket_name}:'+str(e))
+            
+    def _query(self, bucket_name, key, expression, fp, engine, kwargs):
+        if engine != 'local':
+            counter = ByteCounter(fp)
+            try:
+                return s3_select(
+                        self._s3c, bucket_name, key, expression, counter, 
+                        **kwargs)
+            except EventStreamError:
+                # failed mid-stream, records may be written already.
+                raise
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if engine == 's3' or code in ('NoSuchKey', 'NoSuchBucket'):
+                    raise
+                self._logger.warning(
+                        f's3 select failed ({code}), evaluating locally.')
+            except BotoCoreError as e:
+                # e.g. endpoint, parsing or read errors. Records written
+                # already cannot be taken back.
+                if engine == 's3' or counter.written:
+                    raise
+                self._logger.warning(
+                        f's3 select failed ({e}), evaluating locally.')
+        
+        with self.open(bucket_name, key, 'rb') as stream:
+            select = LocalSelect(stream, stream.raw.size)
+            return select.run(expression, fp, **kwargs)
+            
+    def _ranged_download(self, bucket_name, key, file_name, part_size, 
+                         concurrency, resume):
+        state = DownloadState.load(file_name) if resume else None
+        first = None
+        
+        if state:
+            head = self._s3c.head_object(Bucket=bucket_name, Key=key)
+            if not state.matches(head['ETag'], head['ContentLength']):
+                state.remove()
+                state = None
+        
+        if state is None:
+            # the first range doubles as the size probe, so small objects 
+            # are fetched in a single request.
+            first = self._get_range(bucket_name, key, 0, part_size)
+            size = first['size']
+            if size <= part_size:
+                with open(file_name, 'wb') as fp:
+                    for chunk in first['Body'].iter_chunks(CHUNK_SIZE):
+                        fp.write(chunk)
+                return
+            state = DownloadState(
+                    file_name, first['ETag'], size, part_size)
+            
+        ranges = split_ranges(state.size, state.part_size)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        fd = os.open(file_name, flags)
+        
+        def fetch(i, response=None):
+            start, end = ranges[i]
+            if response is None:
+                response = self._get_range(
+                        bucket_name, key, start, end-start, state.etag)
+            offset = start
+            for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                write_at(fd, chunk, offset)
+                offset += len(chunk)
+            if offset != end:
+                raise IOError(f'short read for range {start}-{end} of {key}.')
+            state.mark(i)
+        
+        try:
+            if os.fstat(fd).st_size != state.size:
+                os.ftruncate(fd, state.size)
+            state.open()
+            
+            if first is not None:
+                fetch(0, first)
+            
+            pending = [(i,) for i in range(len(ranges)) 
+                        if i not in state.done]
+            run_parallel(fetch, pending, concurrency)
+        finally:
+            os.close(fd)
+            state.close()
+            
+        state.remove()
+        
+    def _get_range(self, bucket_name, key, start, length, etag=None):
+        return get_range(self._s3c, bucket_name, key, start, length, etag)
+    
+    def open(self, bucket_name, key, mode='rb', part_size=None, 
+             concurrency=None, encoding=None):
+        """
+            Open an s3 object as a file-like stream, without a local 
+            copy. In read mode ('rb' or 'r') the object is fetched with 
+            ranged GETs of `part_size`, up to `concurrency` of them read 
+            ahead. In write mode ('wb' or 'w') the data is sent as a 
+            multipart upload as it is written, with up to `concurrency` 
+            parts in flight, and the object appears on close. Text modes 
+            wrap the stream with the given `encoding`.
+        """
+        if mode not in ('r', 'rb', 'w', 'wb'):
+            raise ValueError(f'unsupported mode {mode}.')
+        
+        if mode.startswith('r'):
+            stream = io.BufferedReader(S3Reader(
+                    self._s3c, bucket_name, key, part_size, concurrency),
+                    buffer_size=CHUNK_SIZE)
+        else:
+            stream = S3Writer(
+                    self._s3c, bucket_name, key, part_size, concurrency)
+            
+        if 'b' not in mode:
+            return io.TextIOWrapper(stream, encoding=encoding)
+        return stream
     
     def delete_object(self, bucket_name, key):
         if bucket_name == '' or bucket_name is None:
@@ -224,22 +1027,138 @@ class AwsS3(object):
             msg = f'deleting {key} in {bucket_name}:'+str(e)
             self._logger.error(msg)
             
-    def delete_objects(self, bucket_name, key):
+    def delete_objects(self, bucket_name, key, workers=8, dry_run=False,
+                       verbose=False, key_filter=None):
+        """
+            Delete `key` and all keys under it, or only those with paths 
+            (relative to `key`) matching the `key_filter` if given. The 
+            keys are streamed from a paginated listing in batches of 1000, 
+            with `workers` batch deletes in flight. Returns a list of 
+            (key, error) that failed to delete.
+        """
         if bucket_name == '' or bucket_name is None:
             self._logger.error('missing bucket name.')
             return
         
-        if key == '' or key is None:
+        key = key or ''
+        if key == '' and not key_filter:
             self._logger.error('missing key name.')
             return
         
+        prefix = key if key.endswith('/') or not key else key+'/'
+        def objects():
+            if key_filter:
+                for k in self._list_s3_matching(
+                        bucket_name, prefix, key_filter, True, 1, 
+                        cached=False):
+                    yield {'Key':k}
+                return
+            if prefix != key:
+                yield {'Key':key}
+            for obj in self._list_s3_contents(
+                    bucket_name, prefix, cached=False):
+                yield {'Key':obj['Key']}
+        
         try:
-            bucket = self._s3r.Bucket(bucket_name)
-            bucket.objects.filter(Prefix=key).delete()
-            self.delete_object(bucket_name, key)
+            return self._delete_batches(
+                    bucket_name, objects(), workers, dry_run, verbose)
         except Exception as e:
             msg = f'deleting all under {key} in {bucket_name}:'+str(e)
             self._logger.error(msg)
+            
+    def purge_versions(self, bucket_name, key='', workers=8, dry_run=False,
+                       verbose=False):
+        """
+            Delete all versions and delete markers of `key` and all keys 
+            under it (the whole bucket if `key` is empty), paging through 
+            the versions listing into concurrent batch deletes. Returns a 
+            list of (key, error) that failed to delete.
+        """
+        if bucket_name == '' or bucket_name is None:
+            self._logger.error('missing bucket name.')
+            return
+        
+        try:
+            objects = self._list_s3_versions(bucket_name, key or '')
+            return self._delete_batches(
+                    bucket_name, objects, workers, dry_run, verbose)
+        except Exception as e:
+            msg = f'purging versions under {key} in {bucket_name}:'+str(e)
+            self._logger.error(msg)
+            
+    def _is_versioned(self, bucket_name):
+        response = self._s3c.get_bucket_versioning(Bucket=bucket_name)
+        return response.get('Status') in ('Enabled', 'Suspended')
+    
+    def _list_s3_versions(self, bucket_name, key):
+        # only the key itself and keys under it as a directory.
+        prefix = key if not key or key.endswith('/') else key+'/'
+        kwargs = {'Bucket':bucket_name}
+        if key:
+            kwargs['Prefix'] = key
+        paginator = self._s3c.get_paginator('list_object_versions')
+        for page in paginator.paginate(**kwargs):
+            versions = page.get('Versions') or []
+            markers = page.get('DeleteMarkers') or []
+            for r in versions + markers:
+                if r['Key'] != key and not r['Key'].startswith(prefix):
+                    continue
+                yield {'Key':r['Key'], 'VersionId':r['VersionId']}
+    
+    def _delete_batches(self, bucket_name, objects, workers=8, 
+                        dry_run=False, verbose=False):
+        """
+            Delete a stream of object identifiers (dicts of `Key` and 
+            optionally `VersionId`) with concurrent `DeleteObjects` calls.
+        """
+        progress = Progress('(dryrun) deleted' if dry_run else 'deleted')
+        failures = []
+        batches = []
+        lock = threading.Lock()
+        
+        def delete(batch):
+            if dry_run:
+                for obj in batch:
+                    msg = f'(dryrun) delete s3:///{bucket_name}/{obj["Key"]}'
+                    if obj.get('VersionId'):
+                        msg = msg + f' version {obj["VersionId"]}'
+                    print(msg)
+                progress.add(done=len(batch))
+                return
+            
+            response = self._s3c.delete_objects(
+                    Bucket=bucket_name, 
+                    Delete={'Objects':batch, 'Quiet':True})
+            errors = response.get('Errors', [])
+            for error in errors:
+                msg = f'deleting {error.get("Key")} in {bucket_name}:'
+                self._logger.error(msg+str(error.get('Message')))
+            with lock:
+                failures.extend(
+                        [(e.get('Key'), e.get('Code')) for e in errors])
+                batches.append(len(batch))
+                report = verbose and len(batches) % 10 == 0
+            progress.add(done=len(batch)-len(errors), failed=len(errors))
+            if report:
+                print(progress.report())
+        
+        def tasks():
+            objects_iter = iter(objects)
+            while True:
+                batch = list(itertools.islice(objects_iter, MAX_PAGE_SIZE))
+                if not batch:
+                    return
+                yield delete, batch
+                
+        scheduler = TransferScheduler(workers=workers)
+        for task, e in scheduler.run(tasks()):
+            batch = task[1]
+            failures.extend([(obj['Key'], str(e)) for obj in batch])
+            progress.add(failed=len(batch))
+        
+        if verbose:
+            print(progress.report())
+        return failures
     
     def create_bucket(self, bucket_name, acl, location):
         if bucket_name == '' or bucket_name is None:
@@ -266,14 +1185,29 @@ class AwsS3(object):
             msg = f'creating bucket {bucket_name}:'+str(e)
             self._logger.error(msg)
             
-    def delete_bucket(self, bucket_name):
+    def delete_bucket(self, bucket_name, workers=8, dry_run=False, 
+                      verbose=False):
         if bucket_name == '' or bucket_name is None:
             self._logger.error('missing bucket name.')
             return
         try:
-            bucket = self._s3r.Bucket(bucket_name)
-            bucket.objects.all().delete()
-            bucket.delete()
+            if self._is_versioned(bucket_name):
+                objects = self._list_s3_versions(bucket_name, '')
+            else:
+                objects = ({'Key':obj['Key']} for obj in 
+                           self._list_s3_contents(
+                                   bucket_name, '', cached=False))
+            failures = self._delete_batches(
+                    bucket_name, objects, workers, dry_run, verbose)
+            if failures:
+                msg = f'cannot delete bucket {bucket_name}, not empty.'
+                self._logger.error(msg)
+                return failures
+            if dry_run:
+                print(f'(dryrun) delete bucket {bucket_name}')
+                return failures
+            self._s3c.delete_bucket(Bucket=bucket_name)
+            return failures
         except Exception as e:
             msg = f'deleting bucket {bucket_name}:'+str(e)
             self._logger.error(msg)
@@ -294,15 +1228,261 @@ class AwsS3(object):
         elif len(parts) == 1:
             return 'file', None, None, parts[0]
         else:
-            raise('Illegal path name: {}!'.format(str_path))
+            raise ValueError('Illegal path name: {}!'.format(str_path))
+        
+    def _list_s3_pages(self, bucket_name, key, delimiter='/', 
+                       page_size=None, start_after=None, cached=True):
+        kwargs = {'Bucket':bucket_name, 'Prefix':key}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        
+        config = {}
+        if page_size:
+            config['PageSize'] = min(page_size, MAX_PAGE_SIZE)
+        
+        cache = self._cache if cached and not start_after else None
+        if cache:
+            pages = cache.pages(bucket_name, key, delimiter)
+            if pages is not None:
+                for page in pages:
+                    yield page
+                return
+            listing = cache.begin(bucket_name, key, delimiter)
+        
+        paginator = self._s3c.get_paginator('list_objects_v2')
+        for page in paginator.paginate(PaginationConfig=config, **kwargs):
+            if cache:
+                cache.add(listing, page)
+                if not page.get('IsTruncated'):
+                    # before yielding, so that early exits of callers 
+                    # after the last page still complete the listing.
+                    cache.finish(listing)
+            yield page
+        
+    def _list_s3_objects(self, bucket_name, key, delimiter='/', 
+                         page_size=None, max_keys=None, cached=True):
+        count = 0
+        for page in self._list_s3_pages(
+                bucket_name, key, delimiter=delimiter, page_size=page_size,
+                cached=cached):
+            for r in page.get('Contents',[]):
+                if max_keys and count >= max_keys:
+                    return
+                count += 1
+                yield(r.get('Key'))
+                
+            for r in page.get('CommonPrefixes', []):
+                if max_keys and count >= max_keys:
+                    return
+                count += 1
+                yield(r.get('Prefix'))
+
+    def _list_s3_matching(self, bucket_name, root, key_filter, recursive, 
+                          workers, page_size=None, cached=True):
+        prefix = key_filter.prefix
+        if key_filter.basename:
+            # a name pattern can only narrow the names at the top level, 
+            # where `root` may end with the start of a name.
+            directory = root[:root.rfind('/')+1]
+            partial = root[len(directory):]
+            if recursive or partial.startswith(prefix):
+                start = root
+            elif prefix.startswith(partial):
+                start = directory + prefix
+            else:
+                return
+        else:
+            # a path pattern is matched relative to the directory `root`.
+            if root and not root.endswith('/'):
+                root = root + '/'
+            start = root + prefix
         
-    def _list_s3_objects(self, bucket_name, key):
-        results = self._s3c.list_objects(
-                Bucket=bucket_name,Prefix=key, Delimiter='/')
+        def matches(k):
+            return key_filter(k if key_filter.basename else k[len(root):])
         
-        for r in results.get('Contents',[]):
-            yield(r.get('Key'))
+        if not recursive:
+            for k in self._list_s3_objects(
+                    bucket_name, start, page_size=page_size, cached=cached):
+                if matches(k.rstrip('/')):
+                    yield k
+            return
+        
+        if not key_filter.prunes:
+            for obj in self._list_s3_contents(
+                    bucket_name, start, workers, page_size, cached=cached):
+                if matches(obj['Key']):
+                    yield obj['Key']
+            return
+        
+        def list_level(prefix):
+            keys, prefixes = [], []
+            for page in self._list_s3_pages(
+                    bucket_name, prefix, delimiter='/', page_size=page_size,
+                    cached=cached):
+                keys.extend(r['Key'] for r in page.get('Contents', []))
+                prefixes.extend(
+                        r['Prefix'] for r in page.get('CommonPrefixes', []))
+            return keys, prefixes
+        
+        # breadth first, one delimited listing per surviving prefix.
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            level = [start]
+            while level:
+                following = []
+                for keys, prefixes in executor.map(list_level, level):
+                    for k in keys:
+                        if matches(k):
+                            yield k
+                    following.extend(p for p in prefixes if 
+                                     key_filter.can_descend(p[len(root):]))
+                level = following
+    
+    def _list_s3_contents(self, bucket_name, key, workers=1, 
+                          page_size=None, cached=True):
+        """
+            Recursively list the objects (with their metadata) under 
+            `key`, sharded over `workers` threads if more than one. With
+            `cached` False the listing cache is neither read nor updated,
+            for callers that act on the listing, like deletes and sync.
+        """
+        if workers and workers > 1:
+            for obj in self._list_s3_sharded(
+                    bucket_name, key, workers=workers, page_size=page_size,
+                    cached=cached):
+                yield obj
+            return
+        
+        for page in self._list_s3_pages(
+                bucket_name, key, delimiter=None, page_size=page_size,
+                cached=cached):
+            for obj in page.get('Contents', []):
+                yield obj
             
-        for r in results.get('CommonPrefixes', []):
-            yield(r.get('Prefix'))
+    def _shard_keyspace(self, bucket_name, key, workers, page_size=None,
+                        cached=True):
+        """
+            Split the keys under `key` into shards. If the prefix has a 
+            small number of top-level common prefixes, each of them makes 
+            a shard, and the top-level keys are returned separately. Else 
+            the keyspace is split into character ranges.
+        """
+        pages = self._list_s3_pages(
+                bucket_name, key, delimiter='/', page_size=page_size,
+                cached=cached)
+        page = next(pages, {})
+        pages.close()
+        
+        prefixes = [r.get('Prefix') for r in page.get('CommonPrefixes', [])]
+        if not page.get('IsTruncated') and not prefixes:
+            # the first page is the complete listing.
+            return page.get('Contents', []), []
+        if not page.get('IsTruncated') and len(prefixes) > 1:
+            shards = [(prefix, None, None) for prefix in prefixes]
+            return page.get('Contents', []), shards
+        
+        nsplits = min(len(SHARD_ALPHABET), 4*workers)
+        step = len(SHARD_ALPHABET)/nsplits
+        bounds = [key+SHARD_ALPHABET[int(i*step)] for i in range(1, nsplits)]
+        bounds = [None] + bounds + [None]
+        shards = [(key, lower, upper) for lower, upper in zip(
+                bounds[:-1], bounds[1:])]
+        return [], shards
+    
+    def _list_s3_shard(self, bucket_name, shard, out, stop, page_size=None):
+        """
+            List keys in a shard in the range (`lower`, `upper`] and put 
+            them in the `out` queue, page by page. A `None` marks the end 
+            of the shard.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        prefix, lower, upper = shard
+        try:
+            for page in self._list_s3_pages(
+                    bucket_name, prefix, delimiter=None, page_size=page_size,
+                    start_after=lower, cached=False):
+                contents = page.get('Contents', [])
+                if upper is not None:
+                    contents = [r for r in contents if r.get('Key') <= upper]
+                if contents and not put(contents):
+                    return
+                if len(contents) < len(page.get('Contents', [])):
+                    break
+        except Exception as e:
+            put(e)
+            return
+        put(None)
     
+    def _list_s3_sharded(self, bucket_name, key, workers=8, page_size=None,
+                         cached=True):
+        cache = self._cache if cached else None
+        if cache:
+            pages = cache.pages(bucket_name, key, None)
+            if pages is not None:
+                for page in pages:
+                    for obj in page.get('Contents', []):
+                        yield obj
+                return
+            listing = cache.begin(bucket_name, key, None)
+            batch = []
+        
+        for obj in self._list_s3_merged(
+                bucket_name, key, workers, page_size, cached=cached):
+            if cache:
+                batch.append(obj)
+                if len(batch) == MAX_PAGE_SIZE:
+                    cache.add(listing, {'Contents':batch})
+                    batch = []
+            yield obj
+            
+        if cache:
+            cache.add(listing, {'Contents':batch})
+            cache.finish(listing)
+            
+    def _list_s3_merged(self, bucket_name, key, workers=8, page_size=None,
+                        cached=True):
+        top, shards = self._shard_keyspace(
+                bucket_name, key, workers, page_size=page_size, 
+                cached=cached)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        
+        def drain(out):
+            while True:
+                item = out.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                for obj in item:
+                    yield obj
+        
+        try:
+            outputs = []
+            for shard in shards:
+                out = queue.Queue(maxsize=4)
+                executor.submit(
+                        self._list_s3_shard, bucket_name, shard, out, stop, 
+                        page_size)
+                outputs.append(out)
+            
+            # shards are disjoint and contiguous ranges of the keyspace, 
+            # so draining them in order is sorted. Only the top-level keys 
+            # need to be merged in.
+            shard_objs = itertools.chain.from_iterable(
+                    drain(out) for out in outputs)
+            for obj in heapq.merge(
+                    top, shard_objs, key=lambda r:r.get('Key')):
+                yield obj
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
@@ -0,0 +1,301 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError
+
+from piggin.s3.transfer import (part_size_for, DEFAULT_PART_SIZE,
+                                DEFAULT_CONCURRENCY)
+
+# the write part size doubles every so many parts, so that a stream of
+# unknown length stays within the 10000 parts limit.
+PARTS_PER_STEP = 1000
+
+def get_range(client, bucket_name, key, start, length, etag=None):
+    """
+        GET `length` bytes of an object from `start`, pinned to `etag` if
+        given. The total size of the object is added to the response as
+        `size`.
+    """
+    kwargs = {'Bucket':bucket_name, 'Key':key,
+              'Range':f'bytes={start}-{start+length-1}'}
+    if etag:
+        kwargs['IfMatch'] = etag
+
+    try:
+        response = client.get_object(**kwargs)
+    except ClientError as e:
+        # ranges are not satisfiable for empty objects.
+        if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+            raise
+        kwargs.pop('Range')
+        response = client.get_object(**kwargs)
+
+    content_range = response.get('ContentRange')
+    if content_range:
+        response['size'] = int(content_range.split('/')[-1])
+    else:
+        response['size'] = response['ContentLength']
+    return response
+
+class S3Reader(io.RawIOBase):
+    '''
+        A read-only, seekable file-like view of an s3 object. Sequential
+        reads are served from ranged GETs of `part_size` bytes, with up
+        to `read_ahead` ranges fetched ahead in the background, so at
+        most `read_ahead+1` parts are held in memory. All ranges are
+        pinned to the etag seen on open, a concurrent overwrite of the
+        object fails the read instead of mixing versions. A seek outside
+        the buffered ranges discards them and restarts the read-ahead.
+    '''
+
+    def __init__(self, client, bucket_name, key, part_size=None,
+                 read_ahead=None):
+        self._client = client
+        self._bucket = bucket_name
+        self._key = key
+        self._part_size = part_size or DEFAULT_PART_SIZE
+        self._read_ahead = max(1, read_ahead or DEFAULT_CONCURRENCY)
+
+        # the first range doubles as the size probe.
+        first = get_range(client, bucket_name, key, 0, self._part_size)
+        self.size = first['size']
+        self.etag = first['ETag']
+        self._buffer = first['Body'].read()
+        self._buffer_start = 0
+        self._pos = 0
+        self._next = len(self._buffer)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self._read_ahead)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        else:
+            pos = self.size + offset
+        if pos < 0:
+            raise ValueError(f'negative seek position {pos}.')
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+
+        offset = self._pos - self._buffer_start
+        if not 0 <= offset < len(self._buffer):
+            self._advance()
+            offset = self._pos - self._buffer_start
+
+        n = min(len(b), len(self._buffer) - offset)
+        memoryview(b).cast('B')[:n] = memoryview(self._buffer)[
+                offset:offset+n]
+        self._pos += n
+        return n
+
+    def readall(self):
+        chunks = []
+        while True:
+            chunk = self.read(self._part_size)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _fetch(self, start, end):
+        response = get_range(self._client, self._bucket, self._key, start,
+                             end-start, self.etag)
+        data = response['Body'].read()
+        if len(data) != end-start:
+            msg = f'short read for range {start}-{end} of {self._key}.'
+            raise IOError(msg)
+        return data
+
+    def _schedule(self):
+        while len(self._pending) < self._read_ahead and \
+                self._next < self.size:
+            start = self._next
+            end = min(start+self._part_size, self.size)
+            self._pending.append(
+                    (start, self._executor.submit(self._fetch, start, end)))
+            self._next = end
+
+    def _advance(self):
+        # move the buffer to the range holding the current position,
+        # restarting the read-ahead from there unless it is next in line.
+        self._buffer = b''
+        if not self._pending or self._pending[0][0] != self._pos:
+            self._drop()
+            self._next = self._pos
+        self._schedule()
+        start, future = self._pending.popleft()
+        self._buffer = future.result()
+        self._buffer_start = start
+        self._schedule()
+
+    def _drop(self):
+        while self._pending:
+            self._pending.popleft()[1].cancel()
+
+    def close(self):
+        if not self.closed:
+            self._drop()
+            self._executor.shutdown(wait=False)
+            self._buffer = b''
+        super().close()
+
+class S3Writer(io.BufferedIOBase):
+    '''
+        A write-only file-like object streaming into an s3 object.
+        Written data is cut into parts of `part_size` bytes uploaded as
+        a multipart upload, with up to `concurrency` parts in flight, so
+        at most `concurrency+1` parts are held in memory. The part size
+        doubles every 1000 parts, so streams of unknown length fit the
+        s3 part limit. Streams shorter than a part are sent with a
+        single PutObject on close.
+
+        The object appears on a successful close. Used as a context
+        manager, an exception in the block aborts the upload instead,
+        as does an explicit `abort`.
+    '''
+
+    def __init__(self, client, bucket_name, key, part_size=None,
+                 concurrency=None):
+        self._client = client
+        self._bucket = bucket_name
+        self._key = key
+        self._part_size = part_size_for(0, part_size)
+        self._concurrency = max(1, concurrency or DEFAULT_CONCURRENCY)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._part_number = 0
+        self._futures = set()
+        self._parts = []
+        self._written = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._written
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file.')
+
+        n = len(memoryview(b).cast('B'))
+        self._buffer += b
+        self._written += n
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            self._submit(part)
+        return n
+
+    def _upload_part(self, part_number, data):
+        response = self._client.upload_part(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                PartNumber=part_number, Body=data)
+        return {'PartNumber':part_number, 'ETag':response['ETag']}
+
+    def _submit(self, data):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                    Bucket=self._bucket, Key=self._key)
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(
+                    max_workers=self._concurrency)
+
+        while len(self._futures) >= self._concurrency:
+            done, self._futures = wait(
+                    self._futures, return_when=FIRST_COMPLETED)
+            self._collect(done)
+
+        self._part_number += 1
+        if self._part_number % PARTS_PER_STEP == 0:
+            self._part_size *= 2
+        self._futures.add(self._executor.submit(
+                self._upload_part, self._part_number, data))
+
+    def _collect(self, futures):
+        for f in futures:
+            self._parts.append(f.result())
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                self._client.put_object(
+                        Bucket=self._bucket, Key=self._key,
+                        Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                self._collect(wait(self._futures).done)
+                self._futures = set()
+                parts = sorted(self._parts, key=lambda p:p['PartNumber'])
+                self._client.complete_multipart_upload(
+                        Bucket=self._bucket, Key=self._key,
+                        UploadId=self._upload_id,
+                        MultipartUpload={'Parts':parts})
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._release()
+
+    def abort(self):
+        """
+            discard the data written so far, no object is created.
+        """
+        if self.closed:
+            return
+
+        try:
+            for f in self._futures:
+                f.cancel()
+            if self._upload_id is not None:
+                self._client.abort_multipart_upload(
+                        Bucket=self._bucket, Key=self._key,
+                        UploadId=self._upload_id)
+        finally:
+            self._release()
+
+    def _release(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,166 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import threading
+from collections import namedtuple
+
+from piggin.s3.transfer import part_size_for, split_ranges
+
+# a file or an s3 object, `rel` is the path relative to the sync root.
+Entry = namedtuple('Entry', ['rel', 'size', 'mtime', 'etag'])
+
+CHUNK_SIZE = 1024*1024
+
+def local_entries(path):
+    """
+        stream all files under a local directory, sorted by the relative
+        path in the same order as an s3 listing. Directories are scanned
+        one at a time as the walk reaches them, so only the entries of 
+        the directories on the current path are held in memory.
+    """
+    if not os.path.isdir(path):
+        return
+    yield from _scan(path, '')
+
+def _scan(directory, rel):
+    with os.scandir(directory) as it:
+        entries = list(it)
+
+    # a directory sorts as its keys would, i.e. as `name/`.
+    def order(entry):
+        return entry.name + '/' if entry.is_dir(follow_symlinks=False) \
+            else entry.name
+
+    for entry in sorted(entries, key=order):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan(entry.path, rel + entry.name + '/')
+        elif entry.is_file():
+            stat = entry.stat()
+            yield Entry(rel + entry.name, stat.st_size, stat.st_mtime, None)
+
+def s3_entries(contents, prefix):
+    """
+        convert a (sorted) stream of s3 listing contents under `prefix`
+        to entries. Directory markers are skipped.
+    """
+    for obj in contents:
+        key = obj['Key']
+        if key.endswith('/'):
+            continue
+        yield Entry(key[len(prefix):], obj['Size'],
+                    obj['LastModified'].timestamp(),
+                    obj.get('ETag', '').strip('"'))
+
+def diff(src, dst, compare):
+    """
+        merge-join two sorted streams of entries and yield tuples of
+        (action, source entry, destination entry). The action is 'copy'
+        if the source is missing or different at the destination, and
+        'delete' if the destination has no corresponding source.
+    """
+    src, dst = iter(src), iter(dst)
+    s, d = next(src, None), next(dst, None)
+
+    while s is not None or d is not None:
+        if d is None or (s is not None and s.rel < d.rel):
+            yield 'copy', s, None
+            s = next(src, None)
+        elif s is None or d.rel < s.rel:
+            yield 'delete', None, d
+            d = next(dst, None)
+        else:
+            if not compare(s, d):
+                yield 'copy', s, d
+            s, d = next(src, None), next(dst, None)
+
+def local_etag(path, part_size=None):
+    """
+        compute the etag s3 would assign to the file if uploaded by us,
+        i.e. the md5 for single part uploads, and the md5 of the part
+        md5s suffixed by the number of parts for multipart uploads.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        if part_size is None or size <= part_size:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda:fp.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+
+        part_size = part_size_for(size, part_size)
+        digests = []
+        for start, end in split_ranges(size, part_size):
+            md5 = hashlib.md5()
+            remaining = end - start
+            while remaining:
+                chunk = fp.read(min(CHUNK_SIZE, remaining))
+                md5.update(chunk)
+                remaining -= len(chunk)
+            digests.append(md5.digest())
+
+        return hashlib.md5(b''.join(digests)).hexdigest()+f'-{len(digests)}'
+
+class Md5Cache(object):
+    '''
+        A json backed cache of local file etags, keyed by the path and
+        invalidated by a change in size or modification time.
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.piggin',
+                                'md5cache.json')
+        self._path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._data = {}
+
+        if os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self._data = json.load(fp)
+            except ValueError:
+                self._data = {}
+
+    def etag(self, path, part_size=None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        multipart = part_size is not None and stat.st_size > part_size
+        signature = [stat.st_size, stat.st_mtime_ns,
+                     part_size if multipart else None]
+
+        with self._lock:
+            cached = self._data.get(path)
+        if cached and cached[:3] == signature:
+            return cached[3]
+
+        etag = local_etag(path, part_size)
+        with self._lock:
+            self._data[path] = signature + [etag]
+            self._dirty = True
+        return etag
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(self._data, fp)
+            os.replace(tmp, self._path)
+            self._dirty = False
@@ -0,0 +1,310 @@
+# Copyright 2020 QuantInsti Quantitative Learnings Pvt Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import json
+import math
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+_SENTINEL = object()
+_WRITE_LOCK = threading.Lock()
+
+MB = 1024*1024
+MIN_PART_SIZE = 5*MB
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 8*MB
+DEFAULT_CONCURRENCY = 8
+
+def part_size_for(size, part_size=None):
+    """
+        Return a valid multipart part size for an object of `size` bytes,
+        bumping the requested `part_size` up to the S3 minimum and so that
+        the object fits within the maximum number of parts.
+    """
+    part_size = part_size or DEFAULT_PART_SIZE
+    return max(part_size, MIN_PART_SIZE, int(math.ceil(size/MAX_PARTS)))
+
+def split_ranges(size, part_size):
+    """
+        Split `size` bytes into a list of (start, end) byte ranges of
+        `part_size` each, the end being exclusive.
+    """
+    return [(start, min(start+part_size, size)) for start in range(
+            0, size, part_size)]
+
+def run_parallel(func, items, concurrency):
+    """
+        Call `func` on each of `items` on a pool of `concurrency` threads
+        and return the results in the order of `items`. On the first 
+        failure, the pending calls are cancelled and the error re-raised.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(func, *item) for item in items]
+        try:
+            for f in as_completed(futures):
+                f.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+    return [f.result() for f in futures]
+
+class Progress(object):
+    '''
+        Thread-safe counter of completed and failed items, with the 
+        throughput since start.
+    '''
+    
+    def __init__(self, label):
+        self._label = label
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        
+    def add(self, done=0, failed=0):
+        with self._lock:
+            self.done += done
+            self.failed += failed
+    
+    def report(self):
+        elapsed = max(time.time() - self._start, 1e-6)
+        rate = self.done/elapsed
+        return (f'{self._label} {self.done} objects in {elapsed:.1f}s '
+                f'({rate:.0f}/s), {self.failed} failed.')
+
+def write_at(fd, data, offset):
+    """
+        Write all of `data` to the file descriptor `fd` at `offset`, 
+        without moving the file position where `pwrite` is available.
+    """
+    view = memoryview(data)
+    if not hasattr(os, 'pwrite'):
+        with _WRITE_LOCK:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(fd, view):]
+        return
+    
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+        
+class DownloadState(object):
+    '''
+        Sidecar state file for a ranged download. The first line records
+        the object identity and layout; each finished range appends its
+        index on a line of its own, so updates are cheap and an interrupted
+        download can resume from the ranges already on disk.
+    '''
+    
+    SUFFIX = '.piggin-part'
+    
+    def __init__(self, file_name, etag, size, part_size):
+        self.path = file_name + self.SUFFIX
+        self.etag = etag
+        self.size = size
+        self.part_size = part_size
+        self.done = set()
+        self._lock = threading.Lock()
+        self._fp = None
+        
+    @classmethod
+    def load(cls, file_name):
+        path = file_name + cls.SUFFIX
+        if not os.path.isfile(path) or not os.path.isfile(file_name):
+            return None
+        
+        try:
+            with open(path) as fp:
+                header = json.loads(fp.readline())
+                state = cls(file_name, header['etag'], header['size'], 
+                            header['part_size'])
+                for line in fp:
+                    if line.strip():
+                        state.done.add(int(line))
+        except (ValueError, KeyError):
+            return None
+        
+        return state
+        
+    def matches(self, etag, size):
+        return self.etag == etag and self.size == size
+        
+    def open(self):
+        exists = os.path.isfile(self.path)
+        self._fp = open(self.path, 'a')
+        if not exists:
+            header = {'etag':self.etag, 'size':self.size,
+                      'part_size':self.part_size}
+            self._fp.write(json.dumps(header)+'\n')
+            for i in sorted(self.done):
+                self._fp.write(f'{i}\n')
+            self._fp.flush()
+        return self
+        
+    def mark(self, i):
+        with self._lock:
+            self.done.add(i)
+            self._fp.write(f'{i}\n')
+            self._fp.flush()
+            
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+            
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+class FileSlice(io.RawIOBase):
+    '''
+        A read-only, seekable file-like view of a byte range of a memory
+        mapped file. Reads return views of the map (and `readinto` 
+        copies straight from it), so a part is never copied into a 
+        buffer of its own. Close the slice to release its view, the map
+        cannot be closed while views are alive.
+    '''
+    
+    def __init__(self, mm, start, end):
+        self._view = memoryview(mm)
+        self._start = start
+        self._end = end
+        self._pos = start
+        
+    def __len__(self):
+        return self._end - self._start
+        
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos - self._start
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = self._start + offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        else:
+            pos = self._end + offset
+        self._pos = min(max(pos, self._start), self._end)
+        return self.tell()
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self._end
+        else:
+            end = min(self._pos + size, self._end)
+        data = self._view[self._pos:end]
+        self._pos = end
+        return data
+    
+    def readinto(self, b):
+        end = min(self._pos + len(b), self._end)
+        size = end - self._pos
+        b[:size] = self._view[self._pos:end]
+        self._pos = end
+        return size
+    
+    def close(self):
+        self._view.release()
+        super().close()
+
+class TransferScheduler(object):
+    '''
+        A bounded producer/ consumer pipeline. The caller produces tasks
+        (typically from a streaming listing) into a bounded queue, and a
+        fixed pool of worker threads consumes them. Workers share whatever
+        client the task functions close over, so a single connection pool
+        serves the whole transfer.
+    '''
+
+    def __init__(self, workers=8, queue_size=None):
+        self._workers = max(1, int(workers))
+        if queue_size is None:
+            queue_size = 4*self._workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._failures = []
+        self._done = 0
+        self._logger = logging.getLogger('piggin')
+
+    @property
+    def done(self):
+        return self._done
+
+    @property
+    def failures(self):
+        return list(self._failures)
+
+    def run(self, tasks):
+        """
+            Run the tasks through the worker pool. Each task is a tuple of
+            a callable followed by its arguments. Returns a list of
+            (task, exception) for the failed tasks.
+        """
+        threads = []
+        for i in range(self._workers):
+            t = threading.Thread(
+                    target=self._work, name=f'piggin-transfer-{i}',
+                    daemon=True)
+            t.start()
+            threads.append(t)
+
+        try:
+            for task in tasks:
+                if self._stop.is_set():
+                    break
+                self._queue.put(task)
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for t in threads:
+                self._queue.put(_SENTINEL)
+            for t in threads:
+                t.join()
+
+        return self.failures
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is _SENTINEL:
+                return
+            if self._stop.is_set():
+                continue
+
+            func, args = task[0], task[1:]
+            try:
+                func(*args)
+                with self._lock:
+                    self._done += 1
+            except Exception as e:
+                with self._lock:
+                    self._failures.append((task, e))
+                self._logger.error(f'failed task {args}:'+str(e))
@@ -13,24 +13,32 @@
 # limitations under the License.
 
 import os
-import re
 import logging
 
 from piggin.s3.s3 import AwsS3
+from piggin.s3.filters import KeyFilter, KeyRouter
+from piggin.s3.transfer import TransferScheduler
 
 logger = logging.getLogger('piggin')
 logger.setLevel(logging.INFO)
 
 def copy_from_s3(src, dest, pattern, recursive=False, access_key=None, 
-               secret_key=None, profile=None):
+               secret_key=None, profile=None, workers=8, cache=None):
     """
         Copy files from s3 source to local file system. The pattern will be
-        matched using regex. If `recursive` is False, any directory at the 
+        matched using regex, against the file name, or against the path 
+        relative to `src` if the pattern has a `/`. The literal prefix of 
+        an anchored pattern (e.g. `^data/2020`) narrows the listing, see 
+        `piggin.s3.filters`. If `recursive` is False, any directory at the 
         current level will be skipped. If `dest` is a list, `pattern` must 
         also be a list of equal length. In this case, for each pattern in 
         the list, the corresponding element from `dest` is picked for the 
         destination of the copy operation. This allows to search and copy 
-        multiple files in a single pass through the s3 keys.
+        multiple files in a single pass through the s3 keys, a file 
+        matching several patterns is copied to each of their destinations.
+        All patterns are matched together, see `KeyRouter`. The listing 
+        feeds a bounded queue which is consumed by a pool of `workers` 
+        threads sharing a single client and connection pool.
         
         Args:
             `src (str)`: S3 bucket and key path name.
@@ -47,10 +55,16 @@ def copy_from_s3(src, dest, pattern, recursive=False, access_key=None,
             
             `profile (str)`: AWS profile name.
             
+            `workers (int)`: Number of concurrent listing and download 
+            threads.
+            
+            `cache (ListingCache)`: Optional local listing cache.
+            
         Returns:
             None. Copies the files from source to destination.
     """
-    awsS3 = AwsS3(access_key, secret_key, profile)
+    awsS3 = AwsS3(access_key, secret_key, profile, 
+                  max_pool_connections=max(10, 2*workers), cache=cache)
     
     try:
         _type, bucket, key, _ = awsS3.parse_path('s3:'+src)
@@ -59,45 +73,78 @@ def copy_from_s3(src, dest, pattern, recursive=False, access_key=None,
         
     if _type != 's3':
         raise ValueError('source must be an S3 location.')
-        
-    _type, _, _, path = awsS3.parse_path(dest)
-    if _type == 's3':
-        raise ValueError('destination must be a local fs location.')
     
-    if not os.path.exists(path):
-        raise ValueError('destination location does not exist.')
-        
-    if not os.path.isdir(path):
-        raise ValueError('destination location must be a directory.')
+    # the source is a directory, paths are matched relative to it.
+    if key and not key.endswith('/'):
+        key = key + '/'
         
-    if pattern:
-        p = re.compile(pattern)
+    if isinstance(dest, (list, tuple)):
+        if not isinstance(pattern, (list, tuple)) or \
+                len(pattern) != len(dest):
+            raise ValueError('pattern must be a list of same length as dest.')
+        dests, patterns = list(dest), list(pattern)
     else:
-        p = re.compile('.')
+        dests, patterns = [dest], [pattern]
+        
+    for target in dests:
+        _type, _, _, path = awsS3.parse_path(target)
+        if _type == 's3':
+            raise ValueError('destination must be a local fs location.')
+        
+        if not os.path.exists(path):
+            raise ValueError('destination location does not exist.')
+            
+        if not os.path.isdir(path):
+            raise ValueError('destination location must be a directory.')
+        
+    router = KeyRouter([KeyFilter(p or '.', basename='/' not in (p or ''))
+                        for p in patterns])
         
-    files = awsS3.ls(src)
+    def copy(source, target):
+        # the raising variant, so that failures reach the scheduler.
+        awsS3._copy(source, target)
+        print(f'copied file {source} to {target}.')
     
-    try:
+    def copy_serially(sources, target):
+        for source in sources:
+            copy(source, target)
+    
+    # keys with the same name under different prefixes flatten to the 
+    # same target, only the first one is copied concurrently with other
+    # targets. The later ones are copied after, in listing order, one 
+    # target at a time so that no two downloads write the same file.
+    seen = set()
+    deferred = {}
+    
+    def tasks():
+        files = awsS3.iter_matching(bucket, key, router, 
+                                    recursive=recursive, workers=workers)
         for file in files:
             print(f'processing file {file} in {bucket}, key {key}.')
             if file == key:
                 continue
             if file.endswith('/'):
-                if recursive:
-                    copy_from_s3(
-                            's3:///'+bucket+'/'+file, dest, pattern, 
-                            recursive=recursive, access_key=access_key, 
-                            secret_key=secret_key, profile=profile)
                 continue
             
             name = file.split('/')[-1]
-            if not re.search(p, name):
-                continue
-            
             source = 's3:///'+bucket+'/'+file
-            target = os.path.join(dest, name)
-            awsS3.copy(source, target)
-            print(f'copied file {source} to {target}.')
-    except:
-        logger.error(f'failed copying from s3:{file}')
-        raise
\ No newline at end of file
+            rel = file if router.basename else file[len(key):]
+            for i in router.routes(rel):
+                target = os.path.join(dests[i], name)
+                if target in seen:
+                    deferred.setdefault(target, []).append(source)
+                    continue
+                seen.add(target)
+                yield copy, source, target
+    
+    scheduler = TransferScheduler(workers=workers)
+    failures = scheduler.run(tasks())
+    if deferred:
+        # the failures of both runs.
+        failures = scheduler.run(
+                (copy_serially, sources, target) 
+                for target, sources in deferred.items())
+    if failures:
+        task, e = failures[0]
+        logger.error(f'failed copying to {task[-1]}')
+        raise e
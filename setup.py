@@ -50,5 +50,6 @@ setup(
     include_package_data=True,
     license=namespace["__license__"],
     classifiers=namespace["__package_classifier__"],
-    install_requires=install_requires()
+    install_requires=install_requires(),
+    extras_require={'async': ['aiobotocore']}
 )
\ No newline at end of file